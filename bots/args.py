@@ -142,6 +142,9 @@ def Arg(*args, remainder=False, **kwargs):
     return Argtuple(args, kwargs)
 
 class Argspec(argparse.ArgumentParser):
+    # Argspecs are built once, when the command is registered, and reused
+    # for every invocation. Parsing does not modify the parser, so it is
+    # safe to use the same Argspec for overlapping commands
     def __init__(self, name, *args, **kwargs):
         super().__init__(name, add_help=False, **kwargs)
         for arg in args:
@@ -157,6 +160,53 @@ class Argspec(argparse.ArgumentParser):
                 )
             else:
                 self.add_argument(*arg.args, **arg.kwargs)
+        self.usage_text = self.format_usage().replace('usage: ', 'usage: `')
+        self.simple = self._compile_simple()
+
+    def _compile_simple(self):
+        # If every argument is a plain positional (optionally followed by a
+        # remainder), returns a list of (dest, type, choices) and the dest of
+        # the remainder (or None). Otherwise returns None and argparse is used
+        positionals = []
+        remainder = None
+        for action in self._actions:
+            if action.option_strings or remainder is not None:
+                return None
+            if action.nargs == argparse.REMAINDER:
+                remainder = action.dest
+            elif action.nargs is None and action.default is None:
+                positionals.append((action.dest, action.type, action.choices))
+            else:
+                return None
+        return positionals, remainder
+
+    def _parse_simple(self, args):
+        # Binds tokens directly to a namespace for simple specs.
+        # Returns None if the arguments need the full argparse treatment
+        # (including any error, so that error messages are unchanged)
+        if self.simple is None:
+            return None
+        positionals, remainder = self.simple
+        if len(args) < len(positionals) or (remainder is None and len(args) > len(positionals)):
+            return None
+        namespace = argparse.Namespace()
+        for arg, (dest, _type, choices) in zip(args, positionals):
+            if arg.startswith('-'):
+                return None
+            if _type is not None:
+                try:
+                    arg = _type(arg)
+                except (argparse.ArgumentTypeError, TypeError, ValueError):
+                    return None
+            if choices is not None and arg not in choices:
+                return None
+            setattr(namespace, dest, arg)
+        if remainder is not None:
+            rest = list(args[len(positionals):])
+            if len(rest) and rest[0].startswith('-'):
+                return None
+            setattr(namespace, remainder, rest)
+        return namespace
 
     def _parse_known_args(self, arg_strings, namespace):
         try:
@@ -164,7 +214,7 @@ class Argspec(argparse.ArgumentParser):
         except argparse.ArgumentError as error:
             raise PrebuiltException(
                 '{usage}`\nArgument **{arg}**{help}\n{message}'.format(
-                    usage=self.format_usage().replace('usage: ', 'usage: `'),
+                    usage=self.usage_text,
                     arg=re.sub(r'[<>]','',error.argument_name),
                     help=': '+error.args[0].help if error.args[0].help is not None else '',
                     message=error.message
@@ -173,7 +223,7 @@ class Argspec(argparse.ArgumentParser):
 
     def error(self, message):
         raise PrebuiltException(
-            self.format_usage().replace('usage: ', 'usage: `')+"`\n"+re.sub(r'[<>]','',message)
+            self.usage_text+"`\n"+re.sub(r'[<>]','',message)
         )
 
     def __call__(self, *args, delimiter=None):
@@ -182,6 +232,9 @@ class Argspec(argparse.ArgumentParser):
                 arg for arg in ' '.join(args).split(delimiter)
                 if len(arg)
             ]
+        namespace = self._parse_simple(args)
+        if namespace is not None:
+            return (True, namespace)
         try:
             return (True, super().parse_args(args))
         except PrebuiltException as e:
@@ -6,6 +6,26 @@ import asyncio
 import re
 import datetime
 
+# birthday_index.json : {days: {"month/day": {uid: year}}, announced: "YYYY-MM-DD"}
+def day_key(month, day):
+    return '%d/%d' % (month, day)
+
+def index_birthday(index, uid, data):
+    key = day_key(data['month'], data['day'])
+    if key not in index['days']:
+        index['days'][key] = {}
+    index['days'][key][uid] = data['year']
+
+async def load_index(index):
+    # Builds the calendar index from birthdays.json, if it has not been built yet
+    # Must be called with birthday_index.json open (index)
+    if 'days' not in index:
+        index['days'] = {}
+        async with Database('birthdays.json') as birthdays:
+            for uid, data in birthdays.items():
+                index_birthday(index, uid, data)
+    return index
+
 def EnableBirthday(bot):
     if not isinstance(bot, CoreBot):
         raise TypeError("This function must take a CoreBot")
@@ -23,38 +43,78 @@ def EnableBirthday(bot):
         `$!birthday <your birthday>` : Informs me of your birthday so I
          can congratulate you when it comes. Example: `$!birthday 1/1/1970`
         """
-        async with Database('birthdays.json') as birthdays:
-            birthdays[message.author.id] = {
-                'month': args.birthday.month,
-                'day': args.birthday.day,
-                'year': args.birthday.year
-            }
-            await self.send_message(
-                message.channel,
-                "Okay, I'll remember that"
-            )
-            if self.user.id not in birthdays:
-                birthdays[self.user.id] = {
-                    'month': 5,
-                    'day': 6,
-                    'year': 2017
+        async with Database('birthday_index.json') as index:
+            await load_index(index)
+            async with Database('birthdays.json') as birthdays:
+                if message.author.id in birthdays:
+                    old = birthdays[message.author.id]
+                    key = day_key(old['month'], old['day'])
+                    if key in index['days'] and message.author.id in index['days'][key]:
+                        del index['days'][key][message.author.id]
+                birthdays[message.author.id] = {
+                    'month': args.birthday.month,
+                    'day': args.birthday.day,
+                    'year': args.birthday.year
                 }
-            birthdays.save()
+                index_birthday(index, message.author.id, birthdays[message.author.id])
+                await self.send_message(
+                    message.channel,
+                    "Okay, I'll remember that"
+                )
+                if self.user.id not in birthdays:
+                    birthdays[self.user.id] = {
+                        'month': 5,
+                        'day': 6,
+                        'year': 2017
+                    }
+                    index_birthday(index, self.user.id, birthdays[self.user.id])
+                birthdays.save()
+            index.save()
 
-    @bot.add_task(43200) #12 hours
-    async def check_birthday(self):
-        async with Database('birthdays.json') as birthdays:
+    def arm_birthday_timer(self):
+        # Birthdays are checked once a day, at local midnight
+        self.set_timer(
+            'check_birthday',
+            datetime.datetime.combine(
+                datetime.date.today() + datetime.timedelta(days=1),
+                datetime.time()
+            ).timestamp()
+        )
+
+    @bot.subscribe('after:ready')
+    async def arm_birthdays(self, event):
+        if 'check_birthday' not in self.timers:
+            arm_birthday_timer(self)
+
+    @bot.subscribe('check_birthday') # Timer set by arm_birthday_timer
+    async def check_birthday(self, event):
+        arm_birthday_timer(self)
+        async with Database('birthday_index.json') as index:
+            await load_index(index)
             today = datetime.date.today()
-            for uid, data in birthdays.items():
-                month = data['month']
-                day = data['day']
-                if today.day == day and today.month == month:
-                    await self.send_message(
-                        self.fetch_channel('general'),
-                        "@here Today is %s's **%s** birthday!" % (
-                            get_attr(self.get_user(uid), 'mention', 'Someone'),
-                            postfix(str(today.year - data['year']))
-                        )
+            if 'announced' in index and index['announced'] == today.isoformat():
+                return
+            key = day_key(today.month, today.day)
+            if key in index['days'] and len(index['days'][key]):
+                birthdays = [
+                    '%s\'s **%s**' % (
+                        get_attr(self.get_user(uid), 'mention', 'Someone'),
+                        postfix(str(today.year - year))
+                    )
+                    for uid, year in index['days'][key].items()
+                ]
+                if len(birthdays) == 1:
+                    body = "@here Today is %s birthday!" % birthdays[0]
+                else:
+                    body = "@here Today is:\n%s birthday!" % (
+                        ' birthday,\n'.join(birthdays[:-1]) +
+                        ' birthday, and\n' + birthdays[-1]
                     )
+                await self.send_message(
+                    self.fetch_channel('general'),
+                    body
+                )
+            index['announced'] = today.isoformat()
+            index.save()
 
     return bot
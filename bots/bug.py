@@ -1,13 +1,53 @@
 from .core import CoreBot
-from .utils import ListDatabase, getname, get_attr
+from .utils import ListDatabase, TextIndex, MinHashIndex, getname, get_attr
 from .args import Arg, UserType
 import asyncio
 
+def index_bug(bot, bugid, bug):
+    bot.bug_duplicates.add(bugid, bug['content'])
+    bot.bug_index.set(bugid, 'content', bug['content'])
+    bot.bug_index.set(bugid, 'label', bug['label'])
+    bot.bug_index.set(bugid, 'comments', ' '.join(bug['comments']))
+    set_bug_status(bot, bugid, bug['status'], bug['label'])
+
+def set_bug_status(bot, bugid, status, label):
+    # bug_status is keyed by the lowercase status
+    if bugid in bot.bug_summaries:
+        old = bot.bug_summaries[bugid][0].lower()
+        bot.bug_status[old].discard(bugid)
+        if not len(bot.bug_status[old]):
+            del bot.bug_status[old]
+    if status.lower() not in bot.bug_status:
+        bot.bug_status[status.lower()] = set()
+    bot.bug_status[status.lower()].add(bugid)
+    bot.bug_summaries[bugid] = (status, label)
+
+def format_summaries(bot, bugids):
+    return '\n'.join(
+        '[%d] [%s] : %s' % (bugid, bot.bug_summaries[bugid][0], bot.bug_summaries[bugid][1])
+        for bugid in sorted(bugids)
+    )
+
 def EnableBugs(bot):
     if not isinstance(bot, CoreBot):
         raise TypeError("This function must take a CoreBot")
 
     bot.reserve_channel('bugs')
+    # Search indexes, so that lookups don't have to read bugs.json
+    bot.bug_index = TextIndex() # words in each bug's content, label, and comments
+    bot.bug_status = {} # status (lowercase) -> {bug ids}
+    bot.bug_summaries = {} # bug id -> (status, label)
+    bot.bug_duplicates = MinHashIndex() # similarity of each bug's content
+
+    @bot.subscribe('after:ready')
+    async def load_bug_index(self, event):
+        async with ListDatabase('bugs.json') as bugs:
+            self.bug_index = TextIndex()
+            self.bug_status = {}
+            self.bug_summaries = {}
+            self.bug_duplicates = MinHashIndex()
+            for bugid, bug in enumerate(bugs):
+                index_bug(self, bugid, bug)
 
     @bot.add_command(
         'bug',
@@ -24,6 +64,60 @@ def EnableBugs(bot):
         """
         content = ' '.join([args.message] + args.extra)
         async with ListDatabase('bugs.json') as bugs:
+            # Look for similar open issues
+            matches = [
+                (similarity, bugid)
+                for similarity, bugid in self.bug_duplicates.query(
+                    content,
+                    self.config_get('bug_duplicates', 'suggest', default=0.5)
+                )
+                if self.bug_summaries[bugid][0].lower() != 'closed'
+            ]
+            # Similarity estimates for very short reports are too noisy to merge them automatically
+            mergeable = len(self.bug_duplicates.shingles(content)) >= self.config_get('bug_duplicates', 'min_length', default=3)
+            if mergeable and len(matches) and matches[0][0] >= self.config_get('bug_duplicates', 'merge', default=0.8):
+                # Close enough to be the same issue. The reporter is added to
+                # it, and their report is kept as a comment
+                bugid = matches[0][1]
+                if message.author.id not in bugs[bugid]['users']:
+                    bugs[bugid]['users'].append(message.author.id)
+                bugs[bugid]['comments'].append(
+                    '%s : %s' % (
+                        getname(message.author),
+                        content
+                    )
+                )
+                bugs.save()
+                self.bug_index.add(bugid, 'comments', bugs[bugid]['comments'][-1])
+                await self.send_message(
+                    self.fetch_channel('bugs'),
+                    'Duplicate report added to issue:\n'
+                    '[%d] [%s] %s : %s\n'
+                    'Report: [%s] : %s' % (
+                        bugid,
+                        bugs[bugid]['status'],
+                        ' '.join(
+                            get_attr(self.get_user(user), 'mention', '') for user in
+                            bugs[bugid]['users']
+                        ),
+                        bugs[bugid]['label'],
+                        message.author.mention,
+                        content
+                    )
+                )
+                await self.send_message(
+                    message.channel,
+                    "That looks like an issue which has already been reported, "
+                    "so I've added you to it:\n"
+                    '[%d] [%s] : %s\n'
+                    "You can use `$!bug:thread %d` to see what's been said about it so far" % (
+                        bugid,
+                        bugs[bugid]['status'],
+                        bugs[bugid]['label'],
+                        bugid
+                    )
+                )
+                return
             bugs.append({
                 'users': [message.author.id],
                 'status': 'Pending', #pending->investigating->solution in progress->testing solution->closed
@@ -49,9 +143,13 @@ def EnableBugs(bot):
                     len(bugs)-1,
                     message.author.mention,
                     bugs[-1]['content']
+                ) + (
+                    '\nPossibly related: %s' % ', '.join('[%d]' % bugid for similarity, bugid in matches)
+                    if len(matches) else ''
                 )
             )
             bugs.save()
+            index_bug(self, len(bugs)-1, bugs[-1])
 
     @bot.add_command('thread', Arg('bug', type=int, help="Bug ID"), aliases=['bug:thread'])
     async def cmd_thread(self, message, args):
@@ -126,6 +224,7 @@ def EnableBugs(bot):
                     )
                 )
                 bugs.save()
+                self.bug_index.add(bugid, 'comments', bugs[bugid]['comments'][-1])
 
     @bot.add_command(
         'bug:status',
@@ -160,6 +259,7 @@ def EnableBugs(bot):
                     )
                 )
                 bugs.save()
+                set_bug_status(self, bugid, bugs[bugid]['status'], bugs[bugid]['label'])
 
     @bot.add_command(
         'bug:label',
@@ -197,6 +297,34 @@ def EnableBugs(bot):
                 )
                 bugs[bugid]['label'] = label
                 bugs.save()
+                self.bug_index.set(bugid, 'label', label)
+                set_bug_status(self, bugid, bugs[bugid]['status'], label)
+
+    @bot.add_command('bug:search', Arg('terms', type='extra', help="Search terms"))
+    async def cmd_bug_search(self, message, args):
+        """
+        `$!bug:search <search terms>` : Lists bugs which mention all of the terms
+        in their report, label, or comments. Example: `$!bug:search help session`
+        """
+        results = self.bug_index.search(' '.join([args.terms] + args.extra))
+        await self.send_message(
+            message.channel,
+            format_summaries(self, results) if len(results) else "No bugs matched your search"
+        )
+
+    @bot.add_command('bug:list', Arg('status', type='extra', help="Status"))
+    async def cmd_bug_list(self, message, args):
+        """
+        `$!bug:list <status>` : Lists bugs with the given status.
+        Example: `$!bug:list Pending`
+        """
+        status = ' '.join([args.status] + args.extra).lower()
+        await self.send_message(
+            message.channel,
+            format_summaries(self, self.bug_status[status])
+            if status in self.bug_status
+            else "No bugs with that status"
+        )
 
     @bot.add_command(
         'bug:user',
@@ -228,7 +356,8 @@ def EnableBugs(bot):
                         bugs[bugid]['status'],
                         bugs[bugid]['label'],
                         bugid
-                    )
+                    ),
+                    wait=False
                 )
                 await self.send_message(
                     message.channel,
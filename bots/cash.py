@@ -11,11 +11,76 @@ def ShorthandType(arg):
         raise ArgumentTypeError('Cannot contain spaces')
     return arg
 
+def project_end_time(data):
+    # Projects end at the end of their end date (local time)
+    end = data['end']
+    return (
+        datetime.datetime(end['year'], end['month'], end['day']) +
+        datetime.timedelta(days=1)
+    ).timestamp()
+
 # cash : {project : {goal, current, title, contributions, notified, end, account}}
 def EnableCash(bot):
     if not isinstance(bot, CoreBot):
         raise TypeError("This function must take a CoreBot")
 
+    def arm_project_timers(self, project, data):
+        self.set_timer(
+            'project_end',
+            project_end_time(data),
+            project,
+            key='project_end:'+project
+        )
+        self.set_timer(
+            'project_reminder',
+            data['notified'] + 2628001, #~1 month
+            project,
+            key='project_reminder:'+project
+        )
+
+    async def end_project(self, cash, project):
+        # Announces the end of the project and archives it
+        # Must be called with cash.json open (cash)
+        self.cancel_timer('project_end:'+project)
+        self.cancel_timer('project_reminder:'+project)
+        await self.send_message(
+            self.fetch_channel('general'),
+            "The funding project for %s has ended at %.0f%% of its $%d goal" % (
+                cash[project]['title'],
+                100*(cash[project]['current']/cash[project]['goal']),
+                cash[project]['goal']
+            )
+            + (
+                '\nDonations:\n' +
+                '\n'.join(
+                    '%s: $%d' % (
+                        get_attr(self.get_user(contrib['user']), 'mention', 'Anonymous'),
+                        contrib['amount']
+                    )
+                    for contrib in sorted(
+                        cash[project]['contributions'],
+                        key=lambda x:x['amount'],
+                        reverse=True
+                    )
+                )
+            )
+            + (
+                "\nNice work, and thanks to all the donors!" if
+                cash[project]['current']>=cash[project]['goal']
+                else ""
+            )
+        )
+        async with Database('old_cash.json') as old_cash:
+            old_cash[project] = cash[project]
+            old_cash.save()
+        del cash[project]
+
+    @bot.subscribe('after:ready')
+    async def arm_projects(self, event):
+        async with Database('cash.json') as cash:
+            for project, data in cash.items():
+                arm_project_timers(self, project, data)
+
     @bot.add_command(
         '_payment',
         Arg('project', help="Project shorthand name"),
@@ -116,6 +181,7 @@ def EnableCash(bot):
                 },
                 'account': account
             }
+            arm_project_timers(self, short, cash[short])
             await self.send_message(
                 self.fetch_channel('general'),
                 '%s has started a new funding project:\n'
@@ -160,101 +226,46 @@ def EnableCash(bot):
                     "No funding project with that name"
                 )
             else:
-                await self.send_message(
-                    self.fetch_channel('general'),
-                    "The funding project for %s has ended at %.0f%% of its $%d goal" % (
-                        cash[project]['title'],
-                        100*(cash[project]['current']/cash[project]['goal']),
-                        cash[project]['goal']
-                    )
-                    + (
-                        '\nDonations:\n' +
-                        '\n'.join(
-                            '%s: $%d' % (
-                                get_attr(self.get_user(contrib['user']), 'mention', 'Anonymous'),
-                                contrib['amount']
-                            )
-                            for contrib in sorted(
-                                cash[project]['contributions'],
-                                key=lambda x:x['amount'],
-                                reverse=True
-                            )
-                        )
-                    )
-                    + (
-                        "\nNice work, and thanks to all the donors!" if
-                        cash[project]['current']>=cash[project]['goal']
-                        else ""
-                    )
-                )
-                async with Database('old_cash.json') as old_cash:
-                    old_cash[project] = cash[project]
-                    old_cash.save()
-                del cash[project]
+                await end_project(self, cash, project)
                 cash.save()
 
-    @bot.add_task(604800) # 1 week
-    async def notify_projects(self):
+    @bot.subscribe('project_end') # Timer set by arm_project_timers
+    async def finish_project(self, event, project):
         async with Database('cash.json') as cash:
-            today = datetime.date.today()
-            for project in [k for k in cash]:
+            if project in cash:
+                await end_project(self, cash, project)
+                cash.save()
+
+    @bot.subscribe('project_reminder') # Timer set by arm_project_timers
+    async def remind_project(self, event, project):
+        async with Database('cash.json') as cash:
+            if project in cash and time.time() >= project_end_time(cash[project]):
+                # Both timers were overdue, and this one fired first
+                await end_project(self, cash, project)
+                cash.save()
+            elif project in cash:
                 data = cash[project]
                 end = data['end']
-                ended = end['year'] < today.year
-                ended |= end['year'] == today.year and end['month'] < today.month
-                ended |= end['year'] == today.year and end['month'] == today.month and end['day'] < today.day
-                if ended:
-                    await self.send_message(
-                        self.fetch_channel('general'),
-                        "The funding project for %s has ended at %.0f%% of its $%d goal" % (
-                            cash[project]['title'],
-                            100*(cash[project]['current']/cash[project]['goal']),
-                            cash[project]['goal']
-                        )
-                        + (
-                            '\nDonations:\n' +
-                            '\n'.join(
-                                '%s: $%d' % (
-                                    get_attr(self.get_user(contrib['user']), 'mention', 'Anonymous'),
-                                    contrib['amount']
-                                )
-                                for contrib in sorted(
-                                    cash[project]['contributions'],
-                                    key=lambda x:x['amount'],
-                                    reverse=True
-                                )
-                            )
-                        )
-                        + (
-                            "\nNice work, and thanks to all the donors!" if
-                            cash[project]['current']>=cash[project]['goal']
-                            else ""
-                        )
-                    )
-                    async with Database('old_cash.json') as old_cash:
-                        old_cash[project] = cash[project]
-                        old_cash.save()
-                    del cash[project]
-                elif time.time() - data['notified'] > 2628001: #~1 month
-                    await self.send_message(
-                        self.fetch_channel('general'),
-                        "Funds are still being collected for %s\n"
-                        "Current progress: $%0.2f/$%d (%.0f%%)\n"
-                        "Project ends: %d/%d/%d\n"
-                        'If you would like to donate, venmo `%s` and mention `%s`'
-                        ' in the payment' % (
-                            data['title'],
-                            data['current'],
-                            data['goal'],
-                            100*(data['current']/data['goal']),
-                            end['month'],
-                            end['day'],
-                            end['year'],
-                            data['account'],
-                            project
-                        )
+                await self.send_message(
+                    self.fetch_channel('general'),
+                    "Funds are still being collected for %s\n"
+                    "Current progress: $%0.2f/$%d (%.0f%%)\n"
+                    "Project ends: %d/%d/%d\n"
+                    'If you would like to donate, venmo `%s` and mention `%s`'
+                    ' in the payment' % (
+                        data['title'],
+                        data['current'],
+                        data['goal'],
+                        100*(data['current']/data['goal']),
+                        end['month'],
+                        end['day'],
+                        end['year'],
+                        data['account'],
+                        project
                     )
-                    cash[project]['notified'] = time.time()
-            cash.save()
+                )
+                cash[project]['notified'] = time.time()
+                arm_project_timers(self, project, cash[project])
+                cash.save()
 
     return bot
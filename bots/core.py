@@ -1,5 +1,7 @@
-from .utils import load_db, save_db, Database, getname, validate_permissions, Interpolator
+from .utils import load_db, save_db, Database, getname, get_attr, validate_permissions, Interpolator, interpolate, PermissionRule, PermissionCache, RateLimit, RateLimiter, chunk_message
 from .args import Arg, Argspec, UserType
+from .outbound import OutboundQueue
+from .executor import BoundedExecutor
 import discord
 from discord.compat import create_task
 import asyncio
@@ -7,26 +9,47 @@ import time
 import os
 import yaml
 import sys
-import threading
 import shlex
+import random
+import heapq
+from collections import deque
+import math
+import traceback
 from functools import wraps
 import re
 
 mention_pattern = re.compile(r'<@.*?(\d+)>')
 
+def message_lane(lane):
+    # Builds the lane function for a command or special (which take the message and content)
+    # 'channel' and 'user' give each channel or user their own lane
+    # Any other name is a single lane shared by everything which uses that name
+    if lane is None:
+        return None
+    if lane == 'channel':
+        return lambda message, content: ('channel', message.channel.id)
+    if lane == 'user':
+        return lambda message, content: ('user', message.author.id)
+    return lambda message, content: lane
+
 class CoreBot(discord.Client):
     nt = 0
     configuration = {}
     primary_server = None
     channel_references = {} # reference name -> channel name/id
     event_listeners = {} # event name -> [listener functions (self, event)]
+    dispatch_table = {} # event name -> ((before:event, listeners), (event, listeners), (after:event, listeners)). See compile_listeners
     # changed to set in favor of event API
     commands = {} # !cmd -> docstring. Functions take (self, message, content)
     ignored_users = set()
     users = {} # id/fullname -> {id, fullname, mention, name}
     tasks = {} # taskname (auto generated) -> [interval(s), qualname] functions take (self)
-    special = {} # eventname -> checker. callable takes (self, message) and returns True if function should be run. Func takes (self, message, content)
+    task_policies = {} # taskname -> [jitter(s), catchup]
+    special = {} # eventname -> checker. callable takes (self, message) and returns True if function should be run. Func takes (self, message, content) (content is None)
     special_order = []
+    permissions = None
+    permission_cache = PermissionCache()
+    rate_limiter = RateLimiter()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -34,8 +57,34 @@ class CoreBot(discord.Client):
             with open('config.yml') as reader:
                 self.configuration = yaml.load(reader)
             self.command_prefix = self.config_get('prefix', default='!')
+        self.outbound = OutboundQueue(self.loop)
+        self.listener_executor = BoundedExecutor(
+            self.loop,
+            limit=self.config_get('dispatch', 'max_concurrent', default=0),
+            limits=self.config_get('dispatch', 'events', default={}),
+            max_queued=self.config_get('dispatch', 'max_queued', default=1000),
+            policy=self.config_get('dispatch', 'policy', default='queue'),
+            protected=['cleanup']
+        )
+        self.dm_channels = {} # user id -> task for the private channel
+        self.interpolators = {} # destination id -> Interpolator
+        self.conversations = {} # (channel id, user id) -> deque([[reply future, check]])
+        self.user_conversations = {} # user id -> deque([(channel id, user id), conversation]), oldest first
+        self.update_times = {'tasks':{}}
+        self._task_heap = [] # [(due time, taskname)]
+        self._task_due = {} # taskname -> due time. Heap entries which disagree are stale
+        self._running_tasks = set()
+        self._tasks_dirty = False
+        self._tasks_saved = 0
+        self._task_wakeup = None
+        self._task_scheduler = None
+        self.timers = load_db('timers.json') # key -> [time, event, args]
+        self._timer_heap = [(timer[0], key) for key, timer in self.timers.items()]
+        heapq.heapify(self._timer_heap)
 
-    def add_command(self, command, *spec, aliases=None, delimiter=None, empty=False, **kwargs): #decorator. Attaches the decorated function to the given command(s)
+    def add_command(self, command, *spec, aliases=None, delimiter=None, empty=False, lane=None, **kwargs): #decorator. Attaches the decorated function to the given command(s)
+        # lane: 'channel', 'user', or the name of a shared lane. Uses of the command in the same lane run one at a time, in order (see message_lane)
+        # The lanes setting in config.yml overrides this
         if aliases is None:
             aliases = []
         for arg in spec:
@@ -46,13 +95,20 @@ class CoreBot(discord.Client):
                 "Warning: (%s) The use of delimiters is discouraged in shlex mode. Instead, "
                 "have users quote their arguments" % command
             )
+        lane = self.config_get('lanes', command, default=lane)
+        limit = self.config_get('rate_limits', command)
+        if limit is not None:
+            limit = RateLimit(command, limit)
         def wrapper(func):
+            argspecs = {} # cmd -> Argspec. Built once for each alias
             @wraps(func)
             async def on_cmd(self, cmd, message, content):
                 if self.check_permissions_chain(self.strip_prefix(cmd), message.author)[0]:
+                    if limit is not None and not await self.check_rate_limit(command, limit, message):
+                        return
                     print("Command in channel", message.channel, "from", message.author, ":", content)
                     if len(spec) or empty:
-                        argspec = Argspec(cmd, *spec, **kwargs)
+                        argspec = argspecs[cmd]
                         if not self.config_get('use_shlex'):
                             delim = delimiter
                         elif delimiter is not None and delimiter not in message.content:
@@ -107,32 +163,95 @@ class CoreBot(discord.Client):
             for cmd in [command] + aliases:
                 if not cmd.startswith(self.command_prefix):
                     cmd = self.command_prefix + cmd
-                on_cmd = self.subscribe(cmd)(on_cmd)
+                if len(spec) or empty:
+                    argspecs[cmd] = Argspec(cmd, *spec, **kwargs)
+                on_cmd = self.subscribe(cmd, lane=message_lane(lane))(on_cmd)
                 self.commands[cmd] = func.__doc__
             return on_cmd
 
         return wrapper
 
-    def add_task(self, interval): #decorator. Sets the decorated function to run on the specified interval
+    def add_task(self, interval, jitter=None, catchup=True): #decorator. Sets the decorated function to run on the specified interval
+        # jitter: Up to this many seconds are randomly added to each run time
+        # (default: 1% of the interval, at most 1 minute)
+        # catchup: If True, a task which missed its run while the bot was offline
+        # runs (once) at startup. If False, it waits for its next regular slot
         def wrapper(func):
             taskname = 'task:'+func.__name__
             if taskname in self.tasks:
                 raise NameError("This task already exists! Change the name of the task function")
             self.tasks[taskname] = (interval, func.__qualname__)
+            self.task_policies[taskname] = (
+                min(interval / 100, 60) if jitter is None else jitter,
+                catchup
+            )
 
             @self.subscribe(taskname)
             async def run_task(self, task):
-                await func(self)
-                if 'tasks' not in self.update_times:
-                    self.update_times['tasks'] = {}
-                self.update_times['tasks'][taskname] = time.time()
-                save_db(self.update_times, 'tasks.json')
+                if taskname in self._running_tasks:
+                    # Single flight. The running instance will reschedule the task
+                    print("Task", taskname, "is already running")
+                    return
+                self._running_tasks.add(taskname)
+                success = False
+                try:
+                    await func(self)
+                    success = True
+                finally:
+                    self._running_tasks.remove(taskname)
+                    if success:
+                        if 'tasks' not in self.update_times:
+                            self.update_times['tasks'] = {}
+                        self.update_times['tasks'][taskname] = time.time()
+                        self._tasks_dirty = True
+                        self.schedule_task(taskname)
+                    else:
+                        # Retry failed tasks after a minute, at the latest
+                        self.schedule_task(taskname, time.time() + min(interval, 60))
 
 
             return run_task
         return wrapper
 
-    def add_special(self, check): #decorator. Sets the decorated function to run whenever the check is true
+    def schedule_task(self, taskname, when=None):
+        # Sets the next run time of a task
+        # By default, the task is scheduled one interval after its last run
+        if when is None:
+            interval, qualname = self.tasks[taskname]
+            last = self.update_times['tasks'][taskname] if taskname in self.update_times['tasks'] else 0
+            when = last + interval + random.uniform(0, self.task_policies[taskname][0])
+        self._task_due[taskname] = when
+        heapq.heappush(self._task_heap, (when, taskname))
+        if self._task_wakeup is not None:
+            self._task_wakeup.set()
+
+    def set_timer(self, event, when, *args, key=None):
+        # Dispatches the event (with args) once, at the given unix timestamp
+        # Timers are saved in timers.json, so they survive restarts. Timers which
+        # were due while the bot was offline fire as soon as it starts up.
+        # Args must be json serializable. Key defaults to the event name, and
+        # setting a timer with an existing key replaces the old timer
+        if key is None:
+            key = event
+        self.timers[key] = [when, event, list(args)]
+        save_db(self.timers, 'timers.json')
+        heapq.heappush(self._timer_heap, (when, key))
+        if self._task_wakeup is not None:
+            self._task_wakeup.set()
+
+    def cancel_timer(self, key):
+        if key in self.timers:
+            del self.timers[key]
+            save_db(self.timers, 'timers.json')
+
+    def save_task_times(self):
+        if self._tasks_dirty:
+            save_db(self.update_times, 'tasks.json')
+            self._tasks_dirty = False
+            self._tasks_saved = time.time()
+
+    def add_special(self, check, lane=None): #decorator. Sets the decorated function to run whenever the check is true
+        # lane works the same as in add_command
         def wrapper(func):
             event = 'special:'+func.__name__
             if event in self.special:
@@ -140,27 +259,61 @@ class CoreBot(discord.Client):
             self.special[event] = check
             self.special_order.append(event)
 
-            @self.subscribe(event)
+            @self.subscribe(event, lane=message_lane(lane))
             async def run_special(self, evt, message, content):
                 await func(self, message, content)
 
             return run_special
         return wrapper
 
-    def subscribe(self, event): # decorator. Sets the decorated function to run on events
+    def subscribe(self, event, inline=False, lane=None): # decorator. Sets the decorated function to run on events
         # event functions should take the event, followed by expected arguments
+        # inline listeners are plain (not async) functions which are called
+        # directly by dispatch instead of in a new task. Only use this for
+        # cheap listeners which never block
+        # lane is an optional function which takes the event arguments and returns
+        # a lane key (or None). Listeners in the same lane run one at a time, in order
         def wrapper(func):
             if str(event) not in self.event_listeners:
                 self.event_listeners[str(event)] = []
             self.event_listeners[str(event)].append(func)
+            func.inline = inline
+            func.lane = lane
+            self.compile_listeners(str(event))
             # func.unsubscribe will unsubscribe the function from the event
             # calling without args unsubscribes from the most recent event that this
             # function was subscribed to. An event can be specified to unsubscribe
             # from a specific event, if the function was subscribed to several
-            func.unsubscribe = lambda x=str(event):self.event_listeners[x].remove(func)
+            def unsubscribe(x=str(event)):
+                self.event_listeners[x].remove(func)
+                self.compile_listeners(x)
+            func.unsubscribe = unsubscribe
             return func
         return wrapper
 
+    def compile_listeners(self, event):
+        # Rebuilds the dispatch table entry covering this event
+        # Events with no listeners at all are left out of the table, so that
+        # dispatch can skip them with a single lookup
+        for prefix in ('before:', 'after:'):
+            if event.startswith(prefix):
+                event = event[len(prefix):]
+                break
+        groups = tuple(
+            (
+                name,
+                tuple(
+                    (listener, get_attr(listener, 'inline', False), get_attr(listener, 'lane', None))
+                    for listener in self.event_listeners.get(name, [])
+                )
+            )
+            for name in ('before:'+event, event, 'after:'+event)
+        )
+        if sum(len(listeners) for name, listeners in groups):
+            self.dispatch_table[event] = groups
+        elif event in self.dispatch_table:
+            del self.dispatch_table[event]
+
     def reserve_channel(self, name):
         # creates a channel reference by that name
         # channel references can be changed in configuration
@@ -187,27 +340,52 @@ class CoreBot(discord.Client):
 
     def dispatch(self, event, *args, manual=False, **kwargs):
         self.nt += 1
-        output = []
-        if not manual:
-            if 'before:'+str(event) in self.event_listeners:
-                output += self.dispatch_event('before:'+str(event), *args, **kwargs)
+        if manual:
+            if event in self.event_listeners:
+                return self.dispatch_event(event, *args, **kwargs)
+            return []
+        if event not in self.dispatch_table:
+            # No listeners. Just run the discord.py handlers
             super().dispatch(event, *args, **kwargs)
-            if str(event) in self.event_listeners:
-                output += self.dispatch_event(str(event), *args, **kwargs)
-            if 'after:'+str(event) in self.event_listeners:
-                output += self.dispatch_event('after:'+str(event), *args, **kwargs)
-        else:
-            if str(event) in self.event_listeners:
-                output += self.dispatch_event(str(event), *args, **kwargs)
+            return []
+        before, listeners, after = self.dispatch_table[event]
+        output = self.run_listeners(*before, args, kwargs) if len(before[1]) else []
+        super().dispatch(event, *args, **kwargs)
+        if len(listeners[1]):
+            output += self.run_listeners(*listeners, args, kwargs)
+        if len(after[1]):
+            output += self.run_listeners(*after, args, kwargs)
         return output
 
     def dispatch_event(self, event, *args, **kwargs):
-        return [
-            create_task(listener(self, event, *args, **kwargs), loop=self.loop)
-            for listener in self.event_listeners[event]
-        ]
-
+        return self.run_listeners(
+            event,
+            [
+                (listener, get_attr(listener, 'inline', False), get_attr(listener, 'lane', None))
+                for listener in self.event_listeners[event]
+            ],
+            args,
+            kwargs
+        )
 
+    def run_listeners(self, event, listeners, args, kwargs):
+        # Starts a task for each listener, except inline listeners which are called immediately
+        # Tasks are started through the listener executor, so they may wait for a free slot
+        output = []
+        for listener, inline, lane in listeners:
+            if inline:
+                try:
+                    listener(self, event, *args, **kwargs)
+                except:
+                    print("Exception in inline listener", listener.__name__, "for", event)
+                    traceback.print_exc()
+            else:
+                output.append(self.listener_executor.submit(
+                    event,
+                    listener(self, event, *args, **kwargs),
+                    lane=lane(*args, **kwargs) if lane is not None else None
+                ))
+        return output
 
     def config_get(self, *keys, default=None):
         obj = self.configuration
@@ -220,6 +398,7 @@ class CoreBot(discord.Client):
 
     async def on_ready(self):
         print("Connected to the following servers")
+        self.interpolators = {}
         if 'primary_server' in self.configuration:
             self.primary_server = discord.utils.get(
                 self.servers,
@@ -250,11 +429,21 @@ class CoreBot(discord.Client):
             name='general',
             type=discord.ChannelType.text
         )
+        self.save_task_times() # In case this is a reconnect
         self.update_times = load_db('tasks.json')
         taskkey = ''.join(sorted(self.tasks))
         if 'key' not in self.update_times or self.update_times['key'] != taskkey:
-            print("Invalidating task time cache")
-            self.update_times = {'key':taskkey, 'tasks':{}}
+            # Only forget tasks which no longer exist. Dropping every time would
+            # make all tasks run right away (ie: paying out weekly allowances again)
+            print("Removing stale tasks from the task time cache")
+            times = self.update_times['tasks'] if 'tasks' in self.update_times else {}
+            self.update_times = {
+                'key':taskkey,
+                'tasks':{
+                    task:when for task, when in times.items()
+                    if task in self.tasks
+                }
+            }
             save_db(self.update_times, 'tasks.json')
         else:
             print("Not invalidating cache")
@@ -281,172 +470,341 @@ class CoreBot(discord.Client):
                     print("Warning: Channel reference", name, "is not defined")
         print(self.channel_references)
         self.ignored_users = set(load_db('ignores.json', []))
-        if os.path.exists('permissions.yml'):
-            with open('permissions.yml') as reader:
-                self.permissions = yaml.load(reader)
-            #get user by name: server.get_member_named
-            #get user by id: server.get_member
-            #iterate over server.role_hierarchy until the command is found (default enabled)
-            #validate the permissions object
-            if not isinstance(self.permissions, dict):
-                sys.exit("permissions.yml must be a dictionary")
-            if 'defaults' not in self.permissions:
-                sys.exit("permissions.yml must define defaults")
-            validate_permissions(self.permissions['defaults'], True)
-            if 'permissions' in self.permissions:
-                if not isinstance(self.permissions['permissions'], list):
-                    sys.exit("permissions key of permissions.yml must be a list")
-            seen_roles = set()
-            for target in self.permissions['permissions']:
-                validate_permissions(target)
-                if 'role' in target:
-                    if target['role'] in seen_roles:
-                        sys.exit("Duplicate role encountered in permissions.yml")
-                    seen_roles.add(target['role'])
-            self.permissions['roles'] = {
-                discord.utils.find(
-                    lambda role: role.name == obj['role'] or role.id == obj['role'],
-                    [_role for server in self.servers for _role in server.roles]
-                ).id:obj for obj in self.permissions['permissions']
-                if 'role' in obj
-            }
-            try:
-                tmp = [
-                    (self.getid(user),obj) for obj in self.permissions['permissions']
-                    if 'users' in obj
-                    for user in obj['users']
-                ]
-            except NameError as e:
-                raise SystemExit("Unable to find user") from e
-            self.permissions['users'] = {}
-            for uid, rule in tmp:
-                if uid not in self.permissions['users']:
-                    self.permissions['users'][uid] = [rule]
-                else:
-                    self.permissions['users'][uid].append(rule)
-            for uid in self.permissions['users']:
-                self.permissions['users'][uid].sort(
-                    key=lambda x:len(x['users'])
-                )
-            self.permissions['defaults']['_grant'] = 'by default'
-            for user in self.permissions['users']:
-                for i in range(len(self.permissions['users'][user])):
-                    nUsers = len(self.permissions['users'][user][i]['users'])
-                    self.permissions['users'][user][i]['_grant'] = (
-                        'directly to you' if nUsers == 1 else
-                        'to you and %d other people' % nUsers
-                    )
-            for role in self.permissions['roles']:
-                self.permissions['roles'][role]['_grant'] = 'by role `%s`' % (
-                    self.permissions['roles'][role]['role']
+        self.load_permissions()
+        current = time.time()
+        for taskname, (interval, qualname) in self.tasks.items():
+            if taskname in self._task_due or taskname in self._running_tasks:
+                # Already scheduled (on_ready runs again after a reconnect)
+                continue
+            jitter, catchup = self.task_policies[taskname]
+            if taskname not in self.update_times['tasks']:
+                self.schedule_task(taskname, current + random.uniform(0, jitter))
+            elif current - self.update_times['tasks'][taskname] < interval:
+                self.schedule_task(taskname)
+            elif catchup:
+                self.schedule_task(taskname, current + random.uniform(0, jitter))
+            else:
+                # Skip missed runs, and resume at the next regular slot
+                last = self.update_times['tasks'][taskname]
+                self.schedule_task(
+                    taskname,
+                    last + interval * (1 + (current - last) // interval)
                 )
-        self.task_worker = threading.Thread(
-            target=CoreBot._run_tasks,
-            args=(self,),
-            daemon=True,
-            name="CoreBot Background Task Thread"
-        )
+        if self._task_scheduler is None or self._task_scheduler.done():
+            self._task_wakeup = asyncio.Event()
+            self._task_scheduler = create_task(self._run_tasks(), loop=self.loop)
 
-        self.task_worker.start()
+    def load_permissions(self):
+        # Reads permissions.yml and compiles it into PermissionRule objects
+        # self.permissions['users'] : user id -> [rules] (highest priority first)
+        # self.permissions['roles'] : role id -> rule
+        # self.permissions['defaults'] : rule
+        if not os.path.exists('permissions.yml'):
+            return
+        with open('permissions.yml') as reader:
+            permissions = yaml.load(reader)
+        #validate the permissions object
+        if not isinstance(permissions, dict):
+            sys.exit("permissions.yml must be a dictionary")
+        if 'defaults' not in permissions:
+            sys.exit("permissions.yml must define defaults")
+        validate_permissions(permissions['defaults'], True)
+        if 'permissions' in permissions:
+            if not isinstance(permissions['permissions'], list):
+                sys.exit("permissions key of permissions.yml must be a list")
+        else:
+            permissions['permissions'] = []
+        seen_roles = set()
+        for target in permissions['permissions']:
+            validate_permissions(target)
+            if 'role' in target:
+                if target['role'] in seen_roles:
+                    sys.exit("Duplicate role encountered in permissions.yml")
+                seen_roles.add(target['role'])
+        # role name or id -> role id. The first server to define a name wins
+        role_ids = {}
+        for server in self.servers:
+            for role in server.roles:
+                role_ids.setdefault(role.id, role.id)
+                role_ids.setdefault(role.name, role.id)
+        compiled = {
+            'defaults': PermissionRule(permissions['defaults'], 'by default'),
+            'roles': {},
+            'users': {},
+        }
+        for obj in permissions['permissions']:
+            if 'role' in obj:
+                if obj['role'] not in role_ids:
+                    sys.exit("Unable to find role '%s'" % obj['role'])
+                compiled['roles'][role_ids[obj['role']]] = PermissionRule(
+                    obj,
+                    'by role `%s`' % obj['role']
+                )
+            else:
+                nUsers = len(obj['users'])
+                rule = PermissionRule(
+                    obj,
+                    'directly to you' if nUsers == 1 else
+                    'to you and %d other people' % nUsers
+                )
+                for user in obj['users']:
+                    try:
+                        uid = self.getid(user)
+                    except NameError as e:
+                        raise SystemExit("Unable to find user") from e
+                    if uid not in compiled['users']:
+                        compiled['users'][uid] = [rule]
+                    else:
+                        compiled['users'][uid].append(rule)
+        for uid in compiled['users']:
+            compiled['users'][uid].sort(
+                key=lambda rule:len(rule.source['users'])
+            )
+        self.permissions = compiled
+        self.permission_cache.clear()
 
     async def shutdown(self):
         tasks = self.dispatch('cleanup')
         if len(tasks):
             print("Waiting for ", len(tasks), "cleanup tasks to complete")
             await asyncio.wait(tasks)
+        self.save_task_times()
         await self.close()
 
-    async def send_message(self, destination, content, *, delim='\n', quote='', interp=None, **kwargs):
-        #built in chunking
+    async def send_message(self, destination, content, *, delim=None, quote='', interp=None, wait=True, coalesce=True, **kwargs):
+        #built in chunking (see utils.chunk_message). delim is no longer used
+        # Messages are delivered in order through the outbound queue for the destination
+        # By default, this waits for delivery and returns the last message sent
+        # If wait is False, this returns immediately with a future for the last message
+        # If coalesce_window is set, the message may be merged with others to the same
+        # destination. Set coalesce to False if the returned message must only contain this content
         if interp is None:
-            interp = Interpolator(self, destination)
+            interp = self.get_interpolator(destination)
         elif interp is False:
             interp = {}
         elif isinstance(interp, Interpolator):
-            tmp = Interpolator(self, destination)
-            tmp.update(**interp)
-            interp = tmp
+            interp = {**self.get_interpolator(destination), **interp}
         elif isinstance(interp, discord.Channel):
-            interp = Interpolator(self, interp)
+            interp = self.get_interpolator(interp)
         elif not isinstance(interp, dict):
             raise TypeError("Cannot infer interpolation settings from an object of type "+type(interp))
         try:
-            for key in interp:
-                content = content.replace(key, interp[key])
+            content = interpolate(content, interp)
         except:
             print("Interpolation Error: ", {**interp})
-        for match in mention_pattern.finditer(content):
-            uid = match.group(1)
-            do_sub = isinstance(destination, discord.User) and destination.id != uid
-            do_sub |= hasattr(destination, 'server') and self.get_user(uid, destination.server) is None
-            do_sub |= hasattr(destination, 'recipients') and uid not in {user.id for user in destination.recipients}
-            if do_sub:
-                # have to replace the mention with a `@Username`
-                user = self.get_user(uid)
-                if user is not None:
-                    content = content.replace(
-                        match.group(0),
-                        '`@%s#%s`' % (user.name, str(user.discriminator)),
-                        1
-                    )
-        body = content.split(delim)
-        tmp = []
-        last_msg = None
-        for line in body:
-            tmp.append(line)
-            msg = delim.join(tmp)
-            if len(msg) > 2048 and delim=='. ':
-                # If the message is > 2KB and we're trying to split by sentences,
-                # try to split it up by spaces
-                last_msg = await self.send_message(
+        if '<@' in content:
+            # Mentions of users outside the destination are replaced with `@Username`
+            # Each user is only checked once per message
+            server = destination.server if hasattr(destination, 'server') else None
+            recipients = (
+                {user.id for user in destination.recipients}
+                if hasattr(destination, 'recipients')
+                else None
+            )
+            replacements = {} # uid -> replacement text, or None to keep the mention
+
+            def rewrite_mention(match):
+                uid = match.group(1)
+                if uid not in replacements:
+                    replacements[uid] = None
+                    do_sub = isinstance(destination, discord.User) and destination.id != uid
+                    do_sub |= server is not None and server.get_member(uid) is None
+                    do_sub |= recipients is not None and uid not in recipients
+                    if do_sub:
+                        user = self.get_user(uid)
+                        if user is not None:
+                            replacements[uid] = '`@%s#%s`' % (user.name, str(user.discriminator))
+                if replacements[uid] is None:
+                    return match.group(0)
+                return replacements[uid]
+
+            content = mention_pattern.sub(rewrite_mention, content)
+        key = get_attr(destination, 'id', destination)
+        send = super().send_message # zero-argument super() doesn't work inside the comprehension
+        chunks = [quote+chunk+quote for chunk in chunk_message(content, quote)]
+        window = self.config_get('coalesce_window', default=0)
+        if coalesce and window > 0 and len(chunks) == 1 and not len(kwargs):
+            # Short plain messages can be merged with others to the same destination
+            futures = [
+                self.outbound.submit_text(
+                    key,
+                    window,
+                    send,
                     destination,
-                    msg,
-                    delim=' ',
-                    interp=False,
-                    **kwargs
+                    chunks[0]
                 )
-            elif len(msg) > 1536 and delim=='\n':
-                # if the message is > 1.5KB and we're trying to split by lines,
-                # try to split by sentences
-                last_msg = await self.send_message(
+            ]
+        else:
+            futures = [
+                self.outbound.submit(
+                    key,
+                    send,
                     destination,
-                    msg,
-                    delim='. ',
-                    interp=False,
+                    chunk,
                     **kwargs
                 )
-            elif len(msg) > 1024:
-                # Otherwise, send it if the current message has reached the
-                # 1KB chunking target
-                try:
-                    last_msg = await super().send_message(
-                        destination,
-                        quote+msg+quote,
-                        **kwargs
-                    )
-                except discord.errors.HTTPException as e:
-                    print("Failed to deliver message:", e.text)
-                    await super().send_message(
-                        self.fetch_channel('dev'),
-                        "Failed to deliver a message to "+str(destination)
-                        )
-                tmp = []
-                await asyncio.sleep(1)
-        if len(tmp):
-            #send any leftovers (guaranteed <2KB)
+                for chunk in chunks
+            ]
+        delivery = create_task(self._deliver(destination, futures), loop=self.loop)
+        if not wait:
+            return delivery
+        return await delivery
+
+    async def _deliver(self, destination, futures):
+        last_msg = None
+        for future in futures:
             try:
-                last_msg = await super().send_message(
-                    destination,
-                    quote+msg+quote
-                )
+                last_msg = await future
             except discord.errors.HTTPException as e:
                 print("Failed to deliver message:", e.text)
-                await super().send_message(
-                    self.fetch_channel('dev'),
-                    "Failed to deliver a message to "+str(destination)
-                )
+                try:
+                    await self.outbound.submit(
+                        self.fetch_channel('dev').id,
+                        super().send_message,
+                        self.fetch_channel('dev'),
+                        "Failed to deliver a message to "+str(destination)
+                    )
+                except discord.errors.HTTPException:
+                    pass
         return last_msg
 
+    def open_conversation(self, channel, user, check=None):
+        # Registers interest in the user's next message in the channel (which passes check)
+        # Returns the conversation. Pass it to await_reply to get the reply
+        # Users can only have a few conversations open. Opening another one
+        # closes their oldest conversation
+        key = (channel.id, user.id)
+        conversation = [self.loop.create_future(), check]
+        if key not in self.conversations:
+            self.conversations[key] = deque()
+        self.conversations[key].append(conversation)
+        if user.id not in self.user_conversations:
+            self.user_conversations[user.id] = deque()
+        self.user_conversations[user.id].append((key, conversation))
+        if len(self.user_conversations[user.id]) > self.config_get('max_conversations', default=3):
+            old_key, old_conversation = self.user_conversations[user.id][0]
+            self.close_conversation(old_key, old_conversation)
+        return key, conversation
+
+    def close_conversation(self, key, conversation):
+        # Unregisters the conversation. If it was still waiting, the reply is None
+        if not conversation[0].done():
+            conversation[0].set_result(None)
+        if key in self.conversations and conversation in self.conversations[key]:
+            self.conversations[key].remove(conversation)
+            if not len(self.conversations[key]):
+                del self.conversations[key]
+            self.user_conversations[key[1]].remove((key, conversation))
+            if not len(self.user_conversations[key[1]]):
+                del self.user_conversations[key[1]]
+
+    def route_reply(self, message):
+        # Hands the message to the oldest open conversation it answers
+        for future, check in self.conversations[(message.channel.id, message.author.id)]:
+            if not future.done() and (check is None or check(message)):
+                future.set_result(message)
+                return
+
+    async def await_reply(self, conversation, timeout=None):
+        # Waits for the reply to a conversation from open_conversation
+        # Returns None if there is no reply within the timeout
+        # (conversation_timeout in config.yml by default)
+        key, conversation = conversation
+        if timeout is None:
+            timeout = self.config_get('conversation_timeout', default=300)
+        try:
+            return await asyncio.wait_for(conversation[0], timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.close_conversation(key, conversation)
+
+    async def wait_for_reply(self, channel, user, *, timeout=None, check=None):
+        # Waits for the user's next message in the channel. Returns None on timeout
+        return await self.await_reply(
+            self.open_conversation(channel, user, check),
+            timeout
+        )
+
+    async def prompt(self, destination, user, content, *, timeout=None, check=None, **kwargs):
+        # Sends content to the destination, then waits for the user to reply there
+        # Returns the reply, or None on timeout
+        if isinstance(destination, discord.User):
+            channel = await self.get_dm_channel(destination)
+        else:
+            channel = destination
+        # Open the conversation first, so that a quick reply isn't missed
+        conversation = self.open_conversation(channel, user, check)
+        try:
+            await self.send_message(destination, content, **kwargs)
+        except:
+            self.close_conversation(*conversation)
+            raise
+        return await self.await_reply(conversation, timeout)
+
+    def get_interpolator(self, destination):
+        # Interpolators are cached for each destination
+        # The cache is invalidated when channels or members are renamed
+        key = get_attr(destination, 'id', None)
+        if key is None:
+            return Interpolator(self, destination)
+        if key not in self.interpolators:
+            self.interpolators[key] = Interpolator(self, destination)
+        return self.interpolators[key]
+
+    async def get_dm_channel(self, user):
+        # Opens (once) and returns the private channel with a user
+        # Concurrent callers share the same request
+        if user.id not in self.dm_channels:
+            self.dm_channels[user.id] = create_task(
+                self.start_private_message(user),
+                loop=self.loop
+            )
+        try:
+            return await self.dm_channels[user.id]
+        except discord.errors.HTTPException:
+            self.dm_channels.pop(user.id, None)
+            raise
+
+    def fan_out(self, messages, concurrency=4):
+        # Sends direct messages to many users without stalling the caller
+        # messages: iterable of (user, content) pairs
+        # At most concurrency messages are in flight at once
+        # Returns a task which resolves to {user id: last message sent, or None if delivery failed}
+        return create_task(
+            self._fan_out(list(messages), concurrency),
+            loop=self.loop
+        )
+
+    async def _fan_out(self, messages, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def deliver(user, content):
+            async with semaphore:
+                try:
+                    # Open the channel up front so sending doesn't have to look it up
+                    await self.get_dm_channel(user)
+                except discord.errors.HTTPException as e:
+                    print("Unable to open a private channel with", user, ":", e.text)
+                    return None
+                return await self.send_message(user, content)
+
+        results = await asyncio.gather(*[
+            deliver(user, content)
+            for user, content in messages
+        ])
+        results = {
+            user.id: msg
+            for (user, content), msg in zip(messages, results)
+        }
+        failed = [uid for uid in results if results[uid] is None]
+        if len(failed):
+            print(
+                "Failed to deliver %d of %d direct messages:" % (len(failed), len(results)),
+                ', '.join(str(self.get_user(uid)) for uid in failed)
+            )
+        return results
+
     def get_user(self, reference, *servers):
         if not len(servers):
             servers = list(self.servers)
@@ -472,19 +830,68 @@ class CoreBot(discord.Client):
             return result.id
         raise NameError("Unable to locate member '%s'. Must use a user ID, username, or username#discriminator" % username)
 
+    async def check_rate_limit(self, command, limit, message):
+        # Returns True if the user may use the command now
+        # Throttled users are told once per throttled period, then ignored
+        user = message.author
+        roles = get_attr(user, 'roles', None)
+        if roles is None:
+            member = self.primary_server.get_member(user.id) if self.primary_server is not None else None
+            roles = get_attr(member, 'roles', [])
+        uses = limit.uses_for(user, roles)
+        if not uses:
+            return True
+        key = (command, user.id)
+        wait = self.rate_limiter.take(key, uses, limit.per)
+        if not wait:
+            return True
+        print("Throttled", user, "using command", command)
+        if self.rate_limiter.should_notify(key, wait):
+            await self.send_message(
+                message.channel,
+                "You're using `$!%s` too often. Please wait %d seconds before trying again" % (
+                    self.strip_prefix(command),
+                    math.ceil(wait)
+                ),
+                wait=False
+            )
+        return False
+
+    def permissions_signature(self, user):
+        # Returns the (cached) role-set signature of a user
+        # Two users with the same signature have the same permissions chain
+        key = (user.id, get_attr(get_attr(user, 'server', None), 'id', None))
+        if key in self.permission_cache.signatures:
+            return self.permission_cache.signatures[key]
+        uid = user.id if user.id in self.permissions['users'] else None
+        if self.primary_server is not None:
+            user = self.primary_server.get_member(user.id)
+        roles = frozenset(
+            role.id for role in user.roles
+            if role.id in self.permissions['roles']
+        ) if hasattr(user, 'roles') and hasattr(user, 'server') else frozenset()
+        signature = (uid, roles)
+        self.permission_cache.signatures[key] = signature
+        return signature
+
     def build_permissions_chain(self, user):
         # Assemble the chain of permissions rules for a given user
+        signature = self.permissions_signature(user)
+        if signature in self.permission_cache.chains:
+            return self.permission_cache.chains[signature]
+        uid, roles = signature
         chain = []
-        if user.id in self.permissions['users']:
-            chain += self.permissions['users'][user.id]
-        if self.primary_server is not None:
-            user = self.primary_server.get_member(user.id)
-        if hasattr(user, 'roles') and hasattr(user, 'server'):
-            user_roles = set(user.roles)
+        if uid is not None:
+            chain += self.permissions['users'][uid]
+        if len(roles):
+            if self.primary_server is not None:
+                user = self.primary_server.get_member(user.id)
             for role in user.server.role_hierarchy:
-                if role in user_roles and role.id in self.permissions['roles']:
+                if role.id in roles:
                     chain.append(self.permissions['roles'][role.id])
-        return [item for item in chain] + [self.permissions['defaults']]
+        chain.append(self.permissions['defaults'])
+        self.permission_cache.chains[signature] = chain
+        return chain
 
     def has_underscore_permissions(self, user, chain=None):
         # Check the permissions chain for a user to see if they can use
@@ -492,77 +899,190 @@ class CoreBot(discord.Client):
         if chain is None:
             #build the chain, if it wasn't given as an argument
             chain = self.build_permissions_chain(user)
-        for obj in chain:
-            if 'underscore' in obj:
-                return obj['underscore']
+        for rule in chain:
+            if rule.underscore is not None:
+                return rule.underscore
 
     def check_permissions_chain(self, cmd, user, chain=None):
         #Important note: cmd argument does not include the leading ! of a command
         # Permissions.yml file contains commands without prefix, and we check them
         # here without the prefix
+        if chain is not None:
+            return self._check_chain(cmd, chain)
+        key = (self.permissions_signature(user), cmd)
+        if key in self.permission_cache.decisions:
+            self.permission_cache.hits += 1
+            return self.permission_cache.decisions[key]
+        self.permission_cache.misses += 1
+        result = self._check_chain(cmd, self.build_permissions_chain(user))
+        self.permission_cache.decisions[key] = result
+        return result
+
+    def _check_chain(self, cmd, chain):
+        for rule in chain:
+            result = rule.check(cmd)
+            if result is not None:
+                return result, rule.grant
+        return (not cmd.startswith('_'), 'by default') #default behavior
+
+    def check_permissions_all(self, cmds, user, chain=None):
+        # Evaluates several commands at once against the permissions chain
+        # Returns a dictionary of cmd -> (allowed, grant)
+        # As with check_permissions_chain, commands should not include the prefix
+        results = {}
+        signature = None
         if chain is None:
-            #build the chain, if it wasn't given as an argument
+            signature = self.permissions_signature(user)
+            pending = set()
+            for cmd in cmds:
+                key = (signature, cmd)
+                if key in self.permission_cache.decisions:
+                    self.permission_cache.hits += 1
+                    results[cmd] = self.permission_cache.decisions[key]
+                else:
+                    self.permission_cache.misses += 1
+                    pending.add(cmd)
+            if not pending:
+                return results
             chain = self.build_permissions_chain(user)
-        for obj in chain:
-            if 'allow' in obj and (cmd in obj['allow'] or '$all' in obj['allow']):
-                return True, obj['_grant']
-            elif 'deny' in obj and (cmd in obj['deny'] or '$all' in obj['deny']):
-                return False, obj['_grant']
-            elif cmd.startswith('_') and 'underscore' in obj:
-                return obj['underscore'], obj['_grant']
-        return (not cmd.startswith('_'), 'by default') #default behavior
+        else:
+            pending = set(cmds)
+        decided = set(pending)
+        underscored = {cmd for cmd in pending if cmd.startswith('_')}
+        for rule in chain:
+            if not pending:
+                break
+            allowed, denied = rule.resolve(pending, underscored)
+            for cmd in allowed:
+                results[cmd] = (True, rule.grant)
+            for cmd in denied:
+                results[cmd] = (False, rule.grant)
+        for cmd in pending:
+            results[cmd] = (cmd not in underscored, 'by default') #default behavior
+        if signature is not None:
+            for cmd in decided:
+                self.permission_cache.decisions[(signature, cmd)] = results[cmd]
+        return results
+
+    def tokenize(self, text):
+        # Splits a message into arguments (respecting quotes in shlex mode)
+        # The first token (the command) is lowercased
+        if self.config_get('use_shlex'):
+            lex = shlex.shlex(text, posix=True)
+            lex.whitespace_split = True
+            content = list(lex)
+        else:
+            content = text.split()
+        content[0] = content[0].lower()
+        return content
 
     async def on_message(self, message):
         if message.author == self.user:
             return
-        if self.get_user(message.author.id) is None:
+        if (message.channel.id, message.author.id) in self.conversations:
+            self.route_reply(message)
+        if message.author.id in self.ignored_users:
+            print("Ignoring message from", message.author,":", message.content)
+            return
+        if message.server is None and self.get_user(message.author.id) is None:
             #User is not a member of any known server
             #silently ignore
             return
-        # build the user struct and update the users object
-        if self.config_get('use_shlex'):
+        text = message.content.strip()
+        if not len(text):
+            return
+        # Cheap check before tokenizing: only messages whose first word is a
+        # known command get fully parsed
+        if text.startswith(self.command_prefix) and text.split(None, 1)[0].lower() in self.commands:
             try:
-                lex = shlex.shlex(message.content.strip(), posix=True)
-                lex.whitespace_split = True
-                content = list(lex)
-                content[0] = content[0].lower()
+                content = self.tokenize(text)
             except:
                 return
-        else:
-            try:
-                content = message.content.strip().split()
-                content[0] = content[0].lower()
-            except:
+            if content[0] in self.commands: #if the first argument is a command
+                # dispatch command event
+                print("Dispatching command")
+                self.dispatch(content[0], message, content)
                 return
-        if message.author.id in self.ignored_users:
-            print("Ignoring message from", message.author,":", content)
-        elif content[0] in self.commands: #if the first argument is a command
-            # dispatch command event
-            print("Dispatching command")
-            self.dispatch(content[0], message, content)
-        else:
-            # If this was not a command, check if any of the special functions
-            # would like to run on this message
-            for event in self.special_order:
-                if self.special[event](self, message):
-                    print("Running special", event)
-                    self.dispatch(event, message, content)
-                    break
-
-    def _run_tasks(self):
-        while True:
-            time.sleep(60)
-            # Check if it is time to run any tasks
-            #
+        # If this was not a command, check if any of the special functions
+        # would like to run on this message
+        # Specials are not tokenized. Use self.tokenize(message.content) if needed
+        for event in self.special_order:
+            if self.special[event](self, message):
+                print("Running special", event)
+                self.dispatch(event, message, None)
+                break
+
+    def protect_event(self, event):
+        # The scheduler forgets tasks and timers once they're dispatched, so
+        # their listeners must never be shed by the listener executor
+        for name in ('before:'+event, event, 'after:'+event):
+            self.listener_executor.protected.add(name)
+
+    async def _run_tasks(self):
+        # Background task and timer scheduler. Runs in the event loop, and sleeps
+        # until the next task or timer is due (or until one is rescheduled)
+        while not self.is_closed:
             current = time.time()
-            ran_task = False
-            for task, (interval, qualname) in self.tasks.items():
-                last = 0
-                if 'tasks' in self.update_times and task in self.update_times['tasks']:
-                    last = self.update_times['tasks'][task]
-                if current - last > interval:
-                    print("Running task", task, '(', qualname, ')')
+            while len(self._task_heap) and self._task_heap[0][0] <= current:
+                due, task = heapq.heappop(self._task_heap)
+                if task not in self._task_due or self._task_due[task] != due:
+                    continue # Stale entry. The task has been rescheduled
+                del self._task_due[task]
+                if task not in self._running_tasks:
+                    print("Running task", task, '(', self.tasks[task][1], ')')
+                    self.protect_event(task)
                     self.dispatch(task)
+            while len(self._timer_heap) and self._timer_heap[0][0] <= current:
+                due, key = heapq.heappop(self._timer_heap)
+                if key not in self.timers or self.timers[key][0] != due:
+                    continue # Stale entry. The timer was cancelled or replaced
+                when, event, args = self.timers.pop(key)
+                save_db(self.timers, 'timers.json')
+                print("Timer", key, "fired")
+                self.protect_event(event)
+                self.dispatch(event, *args)
+            # Task times are written to disk at most once a minute
+            if self._tasks_dirty and current - self._tasks_saved >= 60:
+                self.save_task_times()
+            delay = min(
+                self._task_heap[0][0] if len(self._task_heap) else current + 3600,
+                self._timer_heap[0][0] if len(self._timer_heap) else current + 3600
+            ) - current
+            if self._tasks_dirty:
+                delay = min(delay, self._tasks_saved + 60 - current)
+            self._task_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._task_wakeup.wait(), max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def on_member_update(self, before, after):
+        # The member's roles may have changed
+        self.permission_cache.forget(before.id)
+        if before.name != after.name or get_attr(before, 'nick', None) != get_attr(after, 'nick', None):
+            # Names appear in interpolated $NICK and $CHANNEL values.
+            # Renames are rare enough to just drop the whole cache
+            self.interpolators = {}
+
+    async def on_member_join(self, member):
+        # A returning member may have lost their roles
+        self.permission_cache.forget(member.id)
+
+    async def on_member_remove(self, member):
+        self.permission_cache.forget(member.id)
+
+    async def on_channel_update(self, before, after):
+        self.interpolators.pop(after.id, None)
+
+    async def on_channel_delete(self, channel):
+        self.interpolators.pop(channel.id, None)
+
+    async def on_server_role_update(self, before, after):
+        # Role order determines rule priority
+        self.permission_cache.clear()
+
+    async def on_server_role_delete(self, role):
+        self.permission_cache.clear()
 
     async def on_server_join(self, server):
         if self.primary_server is not None and self.primary_server != server:
@@ -612,7 +1132,46 @@ def EnableUtils(bot): #prolly move to it's own bot
     async def cmd_nt(self, message, content):
         await self.send_message(
             message.channel,
-            '%d events have been dispatched' % self.nt
+            '%d events have been dispatched\n'
+            'Permissions cache: %d hits, %d misses\n'
+            'Outbound: %d sent, %d retried (%d rate limited), %d failed, %d coalesced, %d queued\n'
+            'Listeners: %d running, %d queued (peak %d), %d delayed, %d shed\n'
+            'Rate limits: %d throttled, %d active buckets' % (
+                self.nt,
+                self.permission_cache.hits,
+                self.permission_cache.misses,
+                self.outbound.stats['sent'],
+                self.outbound.stats['retried'],
+                self.outbound.stats['rate_limited'],
+                self.outbound.stats['failed'],
+                self.outbound.stats['coalesced'],
+                self.outbound.pending(),
+                self.listener_executor.total,
+                self.listener_executor.queued,
+                self.listener_executor.stats['peak_queued'],
+                self.listener_executor.stats['delayed'],
+                self.listener_executor.stats['shed'],
+                self.rate_limiter.throttled,
+                len(self.rate_limiter.buckets)
+            )
+        )
+
+    @bot.add_command('_permissions:reload', empty=True)
+    async def cmd_reload_permissions(self, message, content):
+        """
+        `$!_permissions:reload` : Reloads permissions.yml without restarting
+        """
+        try:
+            self.load_permissions()
+        except SystemExit as e:
+            await self.send_message(
+                message.channel,
+                "Unable to reload permissions: %s" % str(e)
+            )
+            return
+        await self.send_message(
+            message.channel,
+            "Permissions reloaded"
         )
 
     @bot.add_command('output-dev', empty=True)
@@ -655,10 +1214,13 @@ def EnableUtils(bot): #prolly move to it's own bot
         """
         `$!permissions` : Gets a list of commands you have permissions to use
         """
-        chain = self.build_permissions_chain(message.author)
+        results = self.check_permissions_all(
+            [self.strip_prefix(command) for command in self.commands],
+            message.author
+        )
         cmds = []
         for command in sorted(self.commands):
-            (allow, rule) = self.check_permissions_chain(self.strip_prefix(command), message.author, chain)
+            (allow, rule) = results[self.strip_prefix(command)]
             if allow:
                 cmds.append((
                     command,
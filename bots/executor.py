@@ -0,0 +1,145 @@
+from discord.compat import create_task
+from collections import deque
+
+class BoundedExecutor(object):
+    # Runs coroutines under a global concurrency cap and per-key caps
+    # (ie: one key per event). Work may also be given a lane. Work in the
+    # same lane runs one at a time, in the order it was submitted, while
+    # different lanes run in parallel.
+    # Work which can't start yet waits in a queue, and starts in order as
+    # slots free up. Under the 'shed' policy, work which arrives while
+    # max_queued items are already waiting is dropped instead (except for
+    # protected keys). A cap of 0 means unlimited
+    def __init__(self, loop, limit=0, limits=None, max_queued=0, policy='queue', protected=()):
+        if policy not in {'queue', 'shed'}:
+            raise ValueError("Unknown dispatch policy '%s'" % policy)
+        self.loop = loop
+        self.limit = limit
+        self.limits = limits if limits is not None else {}
+        self.max_queued = max_queued
+        self.policy = policy
+        self.protected = set(protected) # keys which are never shed. More may be added later
+        self.running = {} # key -> number of running coroutines
+        self.total = 0 # total running coroutines
+        self.busy_lanes = set()
+        self.queue = deque() # [key, lane, coroutine, future] in submission order. Started entries are set to None
+        self.waiting_keys = {} # key -> number of waiting work without a lane
+        self.waiting_lanes = {} # lane -> number waiting
+        self.queued = 0 # total waiting coroutines
+        self.stats = {
+            'started': 0,
+            'delayed': 0,
+            'shed': 0,
+            'peak_queued': 0
+        }
+
+    def submit(self, key, coro, lane=None):
+        # Returns a future for the result of the coroutine
+        # Shed coroutines are closed without running, and their future resolves to None
+        # Laned work only has to wait behind earlier work in its lane. Other
+        # work waits behind earlier work for the same key
+        if lane is not None:
+            ready = lane not in self.waiting_lanes
+        else:
+            ready = key not in self.waiting_keys
+        if ready and self._can_start(key, lane):
+            return self._start(key, lane, coro)
+        if self.policy == 'shed' and self.queued >= self.max_queued and key not in self.protected:
+            coro.close()
+            self.stats['shed'] += 1
+            future = self.loop.create_future()
+            future.set_result(None)
+            return future
+        future = self.loop.create_future()
+        self.queue.append([key, lane, coro, future])
+        if lane is not None:
+            self.waiting_lanes[lane] = self.waiting_lanes[lane] + 1 if lane in self.waiting_lanes else 1
+        else:
+            self.waiting_keys[key] = self.waiting_keys[key] + 1 if key in self.waiting_keys else 1
+        self.queued += 1
+        self.stats['delayed'] += 1
+        self.stats['peak_queued'] = max(self.stats['peak_queued'], self.queued)
+        return future
+
+    def _can_start(self, key, lane):
+        if self.limit and self.total >= self.limit:
+            return False
+        if lane is not None and lane in self.busy_lanes:
+            return False
+        return not self._key_full(key)
+
+    def _key_full(self, key):
+        limit = self.limits[key] if key in self.limits else 0
+        return bool(limit) and key in self.running and self.running[key] >= limit
+
+    def _start(self, key, lane, coro):
+        self.running[key] = self.running[key] + 1 if key in self.running else 1
+        self.total += 1
+        if lane is not None:
+            self.busy_lanes.add(lane)
+        self.stats['started'] += 1
+        task = create_task(coro, loop=self.loop)
+        task.add_done_callback(lambda task: self._finished(key, lane))
+        return task
+
+    def _finished(self, key, lane):
+        self.running[key] -= 1
+        if not self.running[key]:
+            del self.running[key]
+        self.total -= 1
+        self.busy_lanes.discard(lane)
+        self._drain()
+
+    def _dequeue(self, entry):
+        key, lane, coro, future = entry
+        self.queued -= 1
+        if lane is not None:
+            self.waiting_lanes[lane] -= 1
+            if not self.waiting_lanes[lane]:
+                del self.waiting_lanes[lane]
+        else:
+            self.waiting_keys[key] -= 1
+            if not self.waiting_keys[key]:
+                del self.waiting_keys[key]
+
+    def _drain(self):
+        # Starts waiting work in submission order. Laned work which can't
+        # start blocks later work in the same lane. Other work which can't
+        # start blocks later work with the same key. A key only blocks laned
+        # work while it is at its cap
+        blocked_keys = set()
+        blocked_lanes = set()
+        for i, entry in enumerate(self.queue):
+            if self.limit and self.total >= self.limit:
+                break
+            if entry is None:
+                continue
+            key, lane, coro, future = entry
+            if future.cancelled():
+                self._dequeue(entry)
+                self.queue[i] = None
+                coro.close()
+            elif (lane in blocked_lanes if lane is not None else key in blocked_keys) or not self._can_start(key, lane):
+                if lane is not None:
+                    blocked_lanes.add(lane)
+                else:
+                    blocked_keys.add(key)
+            else:
+                self._dequeue(entry)
+                self.queue[i] = None
+                chain(self._start(key, lane, coro), future)
+        while len(self.queue) and self.queue[0] is None:
+            self.queue.popleft()
+
+def chain(task, future):
+    # Copies the outcome of the task into the future
+    def copy(task):
+        if future.cancelled():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+    task.add_done_callback(copy)
@@ -418,23 +418,25 @@ def EnableHelp(bot):
         #     "if you're not sure what sort of things I can do, just say `help`\n"+
         #     "What seems to be the problem?"
         # )
-        prompt = await self.send_message(
+        response = await self.prompt(
+            message.author,
             message.author,
             "Hello! I am $NAME, your personal ~~healthcare~~ **server** companion.\n"
             "Simply type the name of a command that you need help with, or type "
             "`all` to list all of them.\n"
             "What can I help you with?"
         )
-        chain = self.build_permissions_chain(message.author)
+        if response is None:
+            return
+        results = self.check_permissions_all(
+            [self.strip_prefix(cmd) for cmd in self.commands],
+            message.author
+        )
         commands = {
             self.strip_prefix(cmd):trim(self.commands[cmd])
             for cmd in self.commands
-            if self.check_permissions_chain(self.strip_prefix(cmd), message.author, chain)
+            if results[self.strip_prefix(cmd)][0]
         }
-        response = await self.wait_for_message(
-            author=message.author,
-            channel=prompt.channel
-        )
         if response.content.lower() in commands:
             await self.send_message(
                 message.author,
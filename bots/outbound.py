@@ -0,0 +1,121 @@
+import discord
+from discord.compat import create_task
+import aiohttp
+import asyncio
+from collections import deque
+
+class OutboundRequest(object):
+    # A queued call. Several text messages may be merged into one request,
+    # in which case every caller's future resolves to the same result
+    __slots__ = ('func', 'args', 'kwargs', 'futures', 'window', 'idempotent')
+
+    def __init__(self, func, args, kwargs, future, window=0, idempotent=False):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.window = window
+        self.idempotent = idempotent
+
+class OutboundQueue(object):
+    # Ordered, per-destination delivery of requests to Discord
+    # Each destination (key) has its own lane. Lanes run concurrently, but
+    # requests within a lane are sent one at a time, in the order they were
+    # submitted. discord.py's HTTP client waits on Discord's per-route rate
+    # limit buckets, so each lane sends as fast as its bucket allows.
+    # Requests which fail with a 429 or a 502 are retried with exponential
+    # backoff. Idempotent requests (ie: deletes and reactions) are also
+    # retried on any 5xx or connection error. Other requests (ie: sending a
+    # message) may have gone through anyway, and retrying would repeat them
+    def __init__(self, loop, retries=3, backoff=1):
+        self.loop = loop
+        self.retries = retries
+        self.backoff = backoff
+        self.lanes = {} # key -> deque([OutboundRequest])
+        self.stats = {
+            'sent': 0,
+            'retried': 0,
+            'rate_limited': 0,
+            'failed': 0,
+            'coalesced': 0
+        }
+
+    def submit(self, key, func, *args, idempotent=False, **kwargs):
+        # Queues func(*args, **kwargs) in the lane for key
+        # Set idempotent if repeating the request is harmless
+        # Returns a future for the result
+        future = self.loop.create_future()
+        self._enqueue(key, OutboundRequest(func, args, kwargs, future, idempotent=idempotent))
+        return future
+
+    def submit_text(self, key, window, func, destination, content, limit=2000):
+        # Queues func(destination, content) in the lane for key, like submit()
+        # The message is held for window seconds before sending. Any other
+        # text submitted to the same lane in the meantime is appended to it
+        # (on a new line), as long as the result fits within limit
+        future = self.loop.create_future()
+        if key in self.lanes and len(self.lanes[key]):
+            last = self.lanes[key][-1]
+            if last.window > 0 and len(last.args[1]) + 1 + len(content) <= limit:
+                last.args[1] += '\n' + content
+                last.futures.append(future)
+                self.stats['coalesced'] += 1
+                return future
+        self._enqueue(
+            key,
+            OutboundRequest(func, [destination, content], {}, future, window)
+        )
+        return future
+
+    def pending(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def _enqueue(self, key, request):
+        if key not in self.lanes:
+            self.lanes[key] = deque()
+            create_task(self._run_lane(key), loop=self.loop)
+        self.lanes[key].append(request)
+
+    async def _run_lane(self, key):
+        lane = self.lanes[key]
+        try:
+            while len(lane):
+                if lane[0].window > 0:
+                    # Leave the request at the front of the lane while waiting,
+                    # so that later text can still be merged into it
+                    await asyncio.sleep(lane[0].window)
+                    lane[0].window = 0
+                request = lane.popleft()
+                try:
+                    result = await self._attempt(request)
+                except Exception as e:
+                    for future in request.futures:
+                        if not future.cancelled():
+                            future.set_exception(e)
+                else:
+                    for future in request.futures:
+                        if not future.cancelled():
+                            future.set_result(result)
+        finally:
+            del self.lanes[key]
+
+    async def _attempt(self, request):
+        for attempt in range(self.retries + 1):
+            try:
+                result = await request.func(*request.args, **request.kwargs)
+                self.stats['sent'] += 1
+                return result
+            except discord.HTTPException as e:
+                status = e.response.status if e.response is not None else 0
+                retry = status in {429, 502} or (request.idempotent and status >= 500)
+                if attempt >= self.retries or not retry:
+                    self.stats['failed'] += 1
+                    raise
+                if status == 429:
+                    self.stats['rate_limited'] += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= self.retries or not request.idempotent:
+                    self.stats['failed'] += 1
+                    raise
+            self.stats['retried'] += 1
+            await asyncio.sleep(self.backoff * 2 ** attempt)
@@ -7,7 +7,6 @@ from requests.exceptions import RequestException
 import asyncio
 import random
 import shutil
-from datetime import datetime
 
 random.seed()
 
@@ -78,14 +77,19 @@ def EnableOverwatch(bot):
     if not isinstance(bot, CoreBot):
         raise TypeError("This function must take a CoreBot")
 
+    @bot.subscribe('after:ready')
+    async def arm_season_end(self, event):
+        # The end of season timer is set by $!_owinit. This only picks up
+        # seasons started before timers existed
+        if 'ow_season_end' not in self.timers and not os.path.isfile('stats_interim.json'):
+            async with Database('metadata.json') as meta:
+                if 'overwatch_end_date' in meta:
+                    self.set_timer('ow_season_end', meta['overwatch_end_date'])
+
     @bot.add_task(3600) # 1 hour
     async def update_overwatch(self):
         if os.path.isfile('stats_interim.json'):
             return
-        async with Database('metadata.json') as meta:
-            if 'overwatch_end_date' in meta and datetime.today() >= datetime.fromtimestamp(meta['overwatch_end_date']):
-                self.dispatch('ow_season_end')
-                return
         async with Database('stats.json') as state:
             for uid, data in state.items():
                 tag = data['tag']
@@ -221,6 +225,7 @@ def EnableOverwatch(bot):
         async with Database('metadata.json') as meta:
             meta['overwatch_end_date'] = args.end.timestamp()
             meta.save()
+        self.set_timer('ow_season_end', args.end.timestamp())
         shutil.move('stats_interim.json', 'stats.json')
         body = "The new Overwatch season has started! Here are the users I'm "
         body += "currently tracking statistics for:\n"
@@ -9,11 +9,141 @@ import time
 def sanitize_channel(name):
     return sanitize(name, '~!@#$%^*-', '_').rstrip()
 
+def overwrite_payload(target, rule):
+    allow, deny = rule.pair()
+    return {
+        'allow': allow.value,
+        'deny': deny.value,
+        'id': target.id,
+        'type': 'member' if isinstance(target, discord.User) else 'role'
+    }
+
+def voice_overwrites(channel):
+    # Translates a text channel's overwrites into a permission_overwrites
+    # payload with the analogous voice permissions
+    if not hasattr(channel, 'overwrites'):
+        return []
+    return [
+        overwrite_payload(
+            role,
+            discord.PermissionOverwrite(
+                create_instant_invite=src.create_instant_invite,
+                manage_channels=src.manage_channels,
+                manage_roles=src.manage_roles,
+                manage_webhooks=src.manage_webhooks,
+                connect=src.read_messages,
+                send=src.send_messages,
+                mute_members=src.manage_messages,
+                deafen_members=src.manage_messages,
+                move_members=src.manage_messages,
+                use_voice_activation=True
+            )
+        )
+        for role, src in channel.overwrites
+    ]
+
+def add_party(bot, party):
+    bot.parties[party['id']] = party
+    key = (party['server'], party['creator'])
+    if key not in bot.party_creators:
+        bot.party_creators[key] = set()
+    bot.party_creators[key].add(party['id'])
+
+def remove_party(bot, channel_id):
+    bot.cancel_timer('party_expiry:'+channel_id)
+    party = bot.parties.pop(channel_id)
+    key = (party['server'], party['creator'])
+    bot.party_creators[key].discard(channel_id)
+    if not len(bot.party_creators[key]):
+        del bot.party_creators[key]
+    return party
+
+def party_channel(bot, party):
+    # Resolves the party's voice channel through the server's channel id map
+    server = bot.get_server(party['server'])
+    if server is None:
+        return None
+    channel = server.get_channel(party['id'])
+    if channel is None or channel.type != discord.ChannelType.voice:
+        return None
+    return channel
+
+def arm_party_expiry(bot, party):
+    # Parties are disbanded once they are both empty and 24 hours old
+    # While the channel is empty, a single timer is set for when the party
+    # expires (or right away, if it already has). Anyone joining cancels it
+    key = 'party_expiry:'+party['id']
+    channel = party_channel(bot, party)
+    if channel is not None and len(channel.voice_members):
+        bot.cancel_timer(key)
+        return
+    when = max(party['time'] + 86400, time.time())
+    if key not in bot.timers or bot.timers[key][0] > when:
+        bot.set_timer('party_expiry', when, party['id'], key=key)
+
+def party_label(party, channel):
+    return (
+        '`%s`' % party['name']
+        if str(party['name']) == str(channel.name)
+        else '`%s` AKA `%s`' % (
+            channel.name,
+            party['name']
+        )
+    )
+
+async def disband_parties(bot, channel_ids):
+    # Removes the parties and deletes their channels concurrently. Each
+    # deletion is queued in its own outbound lane, so they are still
+    # subject to rate limits and retries
+    # Returns the labels of the channels which were deleted, and the parties
+    # whose channels could not be deleted (which are still tracked)
+    parties = [remove_party(bot, cid) for cid in channel_ids]
+    channels = [party_channel(bot, party) for party in parties]
+    results = await asyncio.gather(
+        *[
+            bot.outbound.submit(('delete_channel', channel.id), bot.delete_channel, channel, idempotent=True)
+            for channel in channels
+            if channel is not None
+        ],
+        return_exceptions=True
+    )
+    results = iter(results)
+    pruned = []
+    failed = []
+    for party, channel in zip(parties, channels):
+        if channel is None:
+            continue
+        result = next(results)
+        if isinstance(result, discord.NotFound):
+            continue
+        elif isinstance(result, Exception):
+            print("Error deleting channel:", type(result), result)
+            # Keep tracking it, since the channel still exists
+            add_party(bot, party)
+            arm_party_expiry(bot, party)
+            failed.append(party)
+        else:
+            pruned.append(party_label(party, channel))
+    return pruned, failed
+
 
 def EnableParties(bot):
     if not isinstance(bot, CoreBot):
         raise TypeError("This function must take a CoreBot")
 
+    bot.parties = {} # channel id -> party
+    bot.party_creators = {} # (server id, creator id) -> {channel ids}
+    bot.party_overwrites = {} # text channel id -> translated permission_overwrites payload
+
+    @bot.subscribe('after:ready')
+    async def load_parties(self, event):
+        async with ListDatabase('parties.json') as parties:
+            self.parties = {}
+            self.party_creators = {}
+            for party in parties:
+                add_party(self, party)
+                arm_party_expiry(self, party)
+
     @bot.add_command('party', Arg('name', remainder=True, help="Optional party name"))
     async def cmd_party(self, message, args):
         """
@@ -22,22 +152,19 @@ def EnableParties(bot):
         """
         if message.server is not None:
             async with ListDatabase('parties.json') as parties:
-                for i in range(len(parties)):
-                    if message.server.id == parties[i]['server'] and message.author.id == parties[i]['creator'] and time.time()-parties[i]['time'] < 86400:
-                        await self.send_message(
+                key = (message.server.id, message.author.id)
+                for cid in sorted(self.party_creators[key]) if key in self.party_creators else []:
+                    if time.time()-self.parties[cid]['time'] < 86400:
+                        response = await self.prompt(
                             message.channel,
+                            message.author,
                             "It looks like you already have a party together right now: `%s`\n"
                             "However, I can disband that party and create this new one for you.\n"
                             "Would you like me to disband your current party? (Yes/No)"
-                            % parties[i]['name']
+                            % self.parties[cid]['name'],
+                            timeout=60
                         )
                         while True:
-                            response = await self.wait_for_message(
-                                timeout=60,
-                                author=message.author,
-                                channel=message.channel,
-                                # check=lambda x:x.content.lower() in {'yes', 'no'}
-                            )
                             if response is None:
                                 await self.send_message(
                                     message.channel,
@@ -56,72 +183,50 @@ def EnableParties(bot):
                                 return
                             elif response.content.lower() == 'yes':
                                 break
-                            await self.send_message(
+                            response = await self.prompt(
                                 message.channel,
+                                message.author,
                                 "I didn't understand your response.\n"
                                 "%s, would you like me to disband your "
-                                "current party? (Yes/No)" % message.author.mention
-                            )
-                        try:
-                            await self.delete_channel(
-                                discord.utils.get(
-                                    message.server.channels,
-                                    id=parties[i]['id'],
-                                    type=discord.ChannelType.voice
-                                )
+                                "current party? (Yes/No)" % message.author.mention,
+                                timeout=60
                             )
-                        except discord.NotFound:
-                            pass
-                        except Exception as e:
-                            print("Error deleting channel:", type(e), e.text, e.response)
+                        pruned, failed = await disband_parties(self, [cid])
+                        if len(failed):
                             await self.send_message(
                                 self.fetch_channel('dev'),
                                 "Error deleting party channel for %s" % message.author.mention
                             )
-                        parties[i] = None
-                parties.update([party for party in parties if party is not None])
                 name = (' '.join(args.name)+' Party') if len(args.name) > 0 else 'Party'
                 name = sanitize_channel(name)
-                party_names = {party['name'] for party in parties}
+                party_names = {party['name'] for party in self.parties.values()}
                 if name in party_names or name == 'Party':
                     suffix = 1
                     name += ' '
                     while name+str(suffix) in party_names:
                         suffix += 1
                     name += str(suffix)
-                perms = []
                 #translate permissions from the text channel where the command was used
-                #into analogous voice permissions
-                if hasattr(message.channel, 'overwrites'):
-                    for role, src in message.channel.overwrites:
-                        dest = discord.PermissionOverwrite(
-                            create_instant_invite=src.create_instant_invite,
-                            manage_channels=src.manage_channels,
-                            manage_roles=src.manage_roles,
-                            manage_webhooks=src.manage_webhooks,
-                            connect=src.read_messages,
-                            send=src.send_messages,
-                            mute_members=src.manage_messages,
-                            deafen_members=src.manage_messages,
-                            move_members=src.manage_messages,
-                            use_voice_activation=True
+                #into analogous voice permissions. The translation is cached until the channel changes
+                if message.channel.id not in self.party_overwrites:
+                    self.party_overwrites[message.channel.id] = voice_overwrites(message.channel)
+                permissions_payload = self.party_overwrites[message.channel.id] + [
+                    # Add specific override for Beymax (so he can kill the channel)
+                    overwrite_payload(
+                        message.server.get_member(self.user.id),
+                        discord.PermissionOverwrite(
+                            manage_channels=True
+                        )
+                    ),
+                    # Add specific override for the channel's creator (so they can modify permissions)
+                    overwrite_payload(
+                        message.author,
+                        discord.PermissionOverwrite(
+                            manage_roles=True,
+                            manage_channels=True # Allow creator to modify the channel
                         )
-                        perms.append((role, dest))
-                # Add specific override for Beymax (so he can kill the channel)
-                perms.append((
-                    message.server.get_member(self.user.id),
-                    discord.PermissionOverwrite(
-                        manage_channels=True
-                    )
-                ))
-                # Add specific override for the channel's creator (so they can modify permissions)
-                perms.append((
-                    message.author,
-                    discord.PermissionOverwrite(
-                        manage_roles=True,
-                        manage_channels=True # Allow creator to modify the channel
                     )
-                ))
+                ]
                 # FIXME: discord.py needs to add category support
                 # channel = await self.create_channel(
                 #     message.server,
@@ -145,39 +250,25 @@ def EnableParties(bot):
                     if target_category is None:
                         raise NameError("No category '%s'"%category_reference)
 
-                @asyncio.coroutine
-                def tmp_create_channel():
-                    permissions_payload = [
-                        {
-                            'allow': rule.pair()[0].value,
-                            'deny': rule.pair()[1].value,
-                            'id': target.id,
-                            'type': 'member' if isinstance(target, discord.User) else 'role'
-                        }
-                        for target, rule in perms
-                    ]
-
-                    def tmp_post_request():
-                        payload = {
-                            'name': name,
-                            'type': str(discord.ChannelType.voice),
-                            'permission_overwrites': permissions_payload,
-                            'parent_id': target_category
-                        }
-                        return self.http.request(
-                            Route(
-                                'POST',
-                                '/guilds/{guild_id}/channels',
-                                guild_id=message.server.id
-                            ),
-                            json=payload,
-                            # reason=None
-                        )
-                    data = yield from tmp_post_request()
-                    channel = discord.Channel(server=message.server, **data)
-                    return channel
-
-                channel = await tmp_create_channel()
+                # Channel creation is rate limited per server, so it goes through the
+                # server's outbound lane
+                data = await self.outbound.submit(
+                    ('create_channel', message.server.id),
+                    self.http.request,
+                    Route(
+                        'POST',
+                        '/guilds/{guild_id}/channels',
+                        guild_id=message.server.id
+                    ),
+                    json={
+                        'name': name,
+                        'type': str(discord.ChannelType.voice),
+                        'permission_overwrites': permissions_payload,
+                        'parent_id': target_category
+                    }
+                    # reason=None
+                )
+                channel = discord.Channel(server=message.server, **data)
                 await self.send_message(
                     message.channel,
                     "Alright, %s, I've created the `%s` channel for you.\n"
@@ -186,17 +277,21 @@ def EnableParties(bot):
                     % (
                         message.author.mention,
                         name
-                    )
+                    ),
+                    wait=False
                 )
-                parties.append({
+                party = {
                     'name':name,
                     'id':channel.id,
                     'server':message.server.id,
                     # 'primed':False,
                     'creator':message.author.id,
                     'time': time.time()
-                })
-            parties.save()
+                }
+                add_party(self, party)
+                arm_party_expiry(self, party)
+                parties.update(list(self.parties.values()))
+                parties.save()
         else:
             await self.send_message(
                 message.channel,
@@ -211,28 +306,12 @@ def EnableParties(bot):
         """
         if message.server is not None:
             async with ListDatabase('parties.json') as parties:
-                pruned = []
-                for i in range(len(parties)):
-                    if message.server.id == parties[i]['server'] and message.author.id == parties[i]['creator']:
-                        channel = discord.utils.get(
-                            self.get_all_channels(),
-                            id=parties[i]['id'],
-                            type=discord.ChannelType.voice
-                        )
-                        if channel is not None:
-                            pruned.append(
-                                '`%s`' % parties[i]['name']
-                                if str(parties[i]['name']) == str(channel.name)
-                                else '`%s` AKA `%s`' % (
-                                    channel.name,
-                                    parties[i]['name']
-                                )
-                            )
-                            await self.delete_channel(
-                                channel
-                            )
-                        parties[i] = None
-                parties.update([party for party in parties if party is not None])
+                key = (message.server.id, message.author.id)
+                pruned, failed = await disband_parties(
+                    self,
+                    list(self.party_creators[key]) if key in self.party_creators else []
+                )
+                parties.update(list(self.parties.values()))
                 parties.save()
             if len(pruned) == 1:
                 await self.send_message(
@@ -253,46 +332,55 @@ def EnableParties(bot):
                     "You don't have an active party"
                 )
 
-    @bot.add_task(600) # 10 min
-    async def prune_parties(self):
-        current = time.time()
+    @bot.subscribe('voice_state_update')
+    async def track_party_occupancy(self, event, before, after):
+        channels = {
+            member.voice.voice_channel.id
+            for member in (before, after)
+            if member.voice.voice_channel is not None
+        }
+        for cid in channels:
+            if cid in self.parties:
+                arm_party_expiry(self, self.parties[cid])
+
+    @bot.subscribe('channel_update', inline=True)
+    def invalidate_party_overwrites(self, event, before, after):
+        self.party_overwrites.pop(before.id, None)
+
+    @bot.subscribe('channel_delete')
+    async def forget_party(self, event, channel):
+        self.party_overwrites.pop(channel.id, None)
+        if channel.id in self.parties:
+            async with ListDatabase('parties.json') as parties:
+                if channel.id in self.parties:
+                    remove_party(self, channel.id)
+                    parties.update(list(self.parties.values()))
+                    parties.save()
+
+    @bot.subscribe('party_expiry') # Timer set by arm_party_expiry
+    async def expire_party(self, event, channel_id):
         async with ListDatabase('parties.json') as parties:
-            pruned = []
-            for i in range(len(parties)):
-                if current - parties[i]['time'] >= 86400: # 24 hours
-                    channel = discord.utils.get(
-                        self.get_all_channels(),
-                        id=parties[i]['id'],
-                        type=discord.ChannelType.voice
-                    )
-                    if channel is None or not len(channel.voice_members):
-                        if channel is not None:
-                            pruned.append(
-                                '`%s`' % parties[i]['name']
-                                if str(parties[i]['name']) == str(channel.name)
-                                else '`%s` AKA `%s`' % (
-                                    channel.name,
-                                    parties[i]['name']
-                                )
-                            )
-                            await self.delete_channel(
-                                channel
-                            )
-                        parties[i] = None
-            parties.update([party for party in parties if party is not None])
+            if channel_id not in self.parties:
+                return
+            channel = party_channel(self, self.parties[channel_id])
+            if channel is not None and len(channel.voice_members):
+                return
+            pruned, failed = await disband_parties(self, [channel_id])
+            if len(failed):
+                # Try again in 10 minutes
+                self.set_timer(
+                    'party_expiry',
+                    time.time() + 600,
+                    channel_id,
+                    key='party_expiry:'+channel_id
+                )
+            parties.update(list(self.parties.values()))
             parties.save()
-        if len(pruned) == 1:
+        if len(pruned):
             await self.send_message(
                 self.fetch_channel('general'),
                 '%s has been disbanded. If you would like to create another party, use the `$!party` command'
                  % pruned[0]
             )
-        elif len(pruned) > 1:
-            await self.send_message(
-                self.fetch_channel('general'),
-                'The following parties have been disbanded:\n'
-                '\n'.join(pruned)+
-                '\nIf you would like to create another party, use the `$!party` command'
-            )
 
     return bot
@@ -1,14 +1,93 @@
 from .core import CoreBot
-from .utils import getname
+from .utils import Database, getname
 from .args import Arg
 import discord
+from discord.compat import create_task
 import asyncio
+import time
+
+# polls.json : {next: int, polls: {poll id: poll}}
+# poll : {
+#   message, channel, creator, title, created,
+#   options: [text], votes: [count for each option],
+#   new_voters: [uids since the last digest]
+# }
+# Polls older than POLL_TRACKING are moved to old_polls.json : {poll id: poll}
+POLL_TRACKING = 2592000 # Votes are tracked for 30 days
+
+def option_emoji(i):
+    # i is the 0-based option index
+    return (b'%d\xe2\x83\xa3'%(i+1)).decode() #hack to create number emoji reactions
+
+option_index = {option_emoji(i):i for i in range(10)}
+
+def format_results(poll):
+    return '\n'.join(
+        ['Results for poll: %s' % poll['title']] +
+        [
+            '%d) %s : %d vote%s' % (
+                num+1,
+                opt,
+                poll['votes'][num],
+                '' if poll['votes'][num] == 1 else 's'
+            )
+            for (num, opt) in enumerate(poll['options'])
+        ]
+    )
+
+async def archive_polls(polls):
+    # Moves polls which are no longer tracked to old_polls.json, so that
+    # saving a vote only rewrites recent polls
+    # Must be called with polls.json open (polls). Returns the archived polls' message ids
+    expired = [
+        poll_id for poll_id, poll in polls['polls'].items()
+        if time.time() - poll['created'] > POLL_TRACKING
+    ]
+    messages = []
+    if len(expired):
+        async with Database('old_polls.json') as old_polls:
+            for poll_id in expired:
+                old_polls[poll_id] = polls['polls'].pop(poll_id)
+                old_polls[poll_id].pop('voters', None) # No longer kept
+                messages.append(old_polls[poll_id]['message'])
+            old_polls.save()
+        polls.save()
+    return messages
+
+async def check_poll_setup(requests):
+    for result in await asyncio.gather(*requests, return_exceptions=True):
+        if isinstance(result, Exception):
+            print("Warning: Unable to finish setting up poll:", result)
 
 def EnablePolls(bot):
     if not isinstance(bot, CoreBot):
         raise TypeError("This function must take a CoreBot")
 
-    bot.polls = {}
+    bot.polls = {} # message id -> poll id, for polls which are being tracked
+
+    @bot.subscribe('after:ready')
+    async def load_polls(self, event):
+        # Reaction events are only sent for cached messages, so recent poll
+        # messages are fetched back into the cache. Votes cast while offline
+        # are picked up from the reaction counts
+        async with Database('polls.json', {'next': 1, 'polls': {}}) as polls:
+            await archive_polls(polls)
+            for poll_id, poll in polls['polls'].items():
+                poll.pop('voters', None) # No longer kept
+                channel = self.get_channel(poll['channel'])
+                if channel is None:
+                    continue
+                try:
+                    target = await self.get_message(channel, poll['message'])
+                except discord.HTTPException:
+                    continue
+                self.messages.append(target)
+                self.polls[target.id] = poll_id
+                for reaction in target.reactions:
+                    emoji = str(reaction.emoji)
+                    if emoji in option_index and option_index[emoji] < len(poll['options']):
+                        poll['votes'][option_index[emoji]] = reaction.count - (1 if reaction.me else 0)
+            polls.save()
 
     @bot.add_command(
         'poll',
@@ -35,7 +114,17 @@ def EnablePolls(bot):
                 " field that you want to leave blank"
             )
         opts = [opt.replace('~<blank>', '') for opt in opts if len(opt)]
-        body = getname(message.author)+" has started a poll:\n"
+        tracked = not isinstance(message.channel, discord.PrivateChannel)
+        if tracked:
+            async with Database('polls.json', {'next': 1, 'polls': {}}) as polls:
+                for mid in await archive_polls(polls):
+                    self.polls.pop(mid, None)
+                poll_id = str(polls['next'])
+                polls['next'] += 1
+                polls.save()
+            body = getname(message.author)+" has started poll #%s:\n" % poll_id
+        else:
+            body = getname(message.author)+" has started a poll:\n"
         body+=args.title+"\n"
         body+="\n".join((
                 "%d) %s"%(num+1, opt)
@@ -43,31 +132,122 @@ def EnablePolls(bot):
                 enumerate(opts)
             ))
         body+="\n\nReact with your vote"
+        if tracked:
+            body+=". To see the results, use `$!poll:results %s`" % poll_id
         target = await self.send_message(
             message.channel,
-            body
+            body,
+            coalesce=False # Reactions are added to this message
         )
-        for i in range(1,len(opts)+1):
-            await self.add_reaction(
+        if target is None:
+            return
+        if tracked:
+            async with Database('polls.json', {'next': 1, 'polls': {}}) as polls:
+                polls['polls'][poll_id] = {
+                    'message': target.id,
+                    'channel': target.channel.id,
+                    'creator': message.author.id,
+                    'title': args.title,
+                    'created': time.time(),
+                    'options': opts,
+                    'votes': [0] * len(opts),
+                    'new_voters': []
+                }
+                polls.save()
+            self.polls[target.id] = poll_id
+        # Reactions go through the outbound queue in their own lane for the
+        # channel. Discord allows one reaction at a time per channel, and they
+        # have to be added in order to show up in order. Deleting the source
+        # message uses a different lane, so it happens alongside the reactions.
+        # The command doesn't wait for either
+        requests = [
+            self.outbound.submit(
+                ('reactions', target.channel.id),
+                self.add_reaction,
                 target,
-                (b'%d\xe2\x83\xa3'%i).decode()#hack to create number emoji reactions
+                option_emoji(i),
+                idempotent=True
             )
-        if not isinstance(message.channel, discord.PrivateChannel):
-            try:
-                await self.delete_message(message)
-            except:
-                print("Warning: Unable to delete poll source message")
-            self.polls[target.id] = (message.author, set())
+            for i in range(len(opts))
+        ]
+        if tracked:
+            requests.append(self.outbound.submit(
+                ('delete', message.channel.id),
+                self.delete_message,
+                message,
+                idempotent=True
+            ))
+        create_task(check_poll_setup(requests), loop=self.loop)
+
+    @bot.add_command('poll:results', Arg('poll', type=int, help="Poll ID"))
+    async def cmd_poll_results(self, message, args):
+        """
+        `$!poll:results <poll ID>` : Displays the current results of a poll.
+        Example: `$!poll:results 2`
+        """
+        async with Database('polls.json', {'next': 1, 'polls': {}}) as polls:
+            poll = polls['polls'][str(args.poll)] if str(args.poll) in polls['polls'] else None
+        if poll is None:
+            async with Database('old_polls.json') as old_polls:
+                poll = old_polls[str(args.poll)] if str(args.poll) in old_polls else None
+        await self.send_message(
+            message.channel,
+            format_results(poll) if poll is not None else "No poll with that ID"
+        )
 
     @bot.subscribe('reaction_add')
     async def on_reaction_add(self, event, reaction, user):
-        if reaction.message.id in self.polls:
-            creator, reactors = self.polls[reaction.message.id]
-            if user.id not in reactors:
-                await self.send_message(
-                    creator,
-                    getname(user)+" has voted on your poll in "+reaction.message.channel.name
-                )
-                self.polls[reaction.message.id][1].add(user.id)
+        emoji = str(reaction.emoji)
+        if reaction.message.id in self.polls and user.id != self.user.id and emoji in option_index:
+            async with Database('polls.json', {'next': 1, 'polls': {}}) as polls:
+                poll_id = self.polls[reaction.message.id]
+                poll = polls['polls'][poll_id]
+                option = option_index[emoji]
+                if option < len(poll['options']):
+                    poll['votes'][option] += 1
+                    if user.id not in poll['new_voters']:
+                        poll['new_voters'].append(user.id)
+                    polls.save()
+                    if 'poll_digest:'+poll_id not in self.timers:
+                        self.set_timer(
+                            'poll_digest',
+                            time.time() + self.config_get('poll_digest_interval', default=3600),
+                            poll_id,
+                            key='poll_digest:'+poll_id
+                        )
+
+    @bot.subscribe('reaction_remove')
+    async def on_reaction_remove(self, event, reaction, user):
+        emoji = str(reaction.emoji)
+        if reaction.message.id in self.polls and user.id != self.user.id and emoji in option_index:
+            async with Database('polls.json', {'next': 1, 'polls': {}}) as polls:
+                poll = polls['polls'][self.polls[reaction.message.id]]
+                option = option_index[emoji]
+                if option < len(poll['options']):
+                    poll['votes'][option] = max(0, poll['votes'][option] - 1)
+                    polls.save()
+
+    @bot.subscribe('poll_digest') # Timer set by on_reaction_add
+    async def send_poll_digest(self, event, poll_id):
+        # Sends the poll's creator one message about everyone who voted since the last digest
+        async with Database('polls.json', {'next': 1, 'polls': {}}) as polls:
+            if poll_id not in polls['polls'] or not len(polls['polls'][poll_id]['new_voters']):
+                return
+            poll = polls['polls'][poll_id]
+            creator = self.get_user(poll['creator'])
+            channel = self.get_channel(poll['channel'])
+            body = "%s voted on your poll in %s since my last update\n%s" % (
+                ', '.join(getname(self.get_user(uid)) for uid in poll['new_voters']),
+                channel.name if channel is not None else 'a channel',
+                format_results(poll)
+            )
+            poll['new_voters'] = []
+            polls.save()
+        if creator is not None:
+            await self.send_message(
+                creator,
+                body,
+                wait=False
+            )
 
     return bot
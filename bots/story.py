@@ -143,6 +143,17 @@ class Player:
 def avg(n):
     return sum(n)/len(n)
 
+def game_deadline(state):
+    # Returns the next time the game needs to be checked (1 day left warning,
+    # 6 hours left warning, and expiry), or None if nobody is playing
+    if state['user'] == '~<IDLE>':
+        return None
+    current = time.time()
+    for offset in (86400, 151200, 172800):
+        if state['time'] + offset > current:
+            return state['time'] + offset
+    return state['time'] + 172800
+
 def EnableStory(bot):
     if not isinstance(bot, CoreBot):
         raise TypeError("This function must take a CoreBot")
@@ -150,6 +161,18 @@ def EnableStory(bot):
     bot.reserve_channel('story')
     bot._pending_activity = set()
 
+    def arm_game_timer(self, state):
+        deadline = game_deadline(state)
+        if deadline is None:
+            self.cancel_timer('check_game')
+        else:
+            self.set_timer('check_game', deadline)
+
+    @bot.subscribe('after:ready')
+    async def arm_story(self, event):
+        async with Database('game.json', {'user':'~<IDLE>'}) as state:
+            arm_game_timer(self, state)
+
     @bot.add_command('games', empty=True)
     async def cmd_story(self, message, content):
         """
@@ -170,7 +193,7 @@ def EnableStory(bot):
         state = load_db('game.json', {'user':'~<IDLE>'})
         return message.channel.id == self.fetch_channel('story').id and state['user'] != '~<IDLE>' and not message.content.startswith(self.command_prefix)
 
-    @bot.add_special(checker)
+    @bot.add_special(checker, lane='story')
     async def state_router(self, message, content):
         # Routes messages depending on the game state
         async with Database('game.json', {'user':'~<IDLE>'}) as state:
@@ -243,6 +266,10 @@ def EnableStory(bot):
                                 "Here's what I'm actually sending to the game: "
                                 "`%s`" % content
                             )
+                        if 'played' in state and not state['played'] and 'notified' not in state and time.time() - state['time'] >= 86400:
+                            # check_game skipped the 1 day left warning because
+                            # the game hadn't been played yet. Check again now
+                            self.set_timer('check_game', time.time())
                         state['played'] = True
                         state['transcript'].append(content)
                         state.save()
@@ -296,7 +323,7 @@ def EnableStory(bot):
                 )
                 state.save()
 
-    @bot.add_command('_start', Arg('game', help="The game to play"))
+    @bot.add_command('_start', Arg('game', help="The game to play"), lane='story')
     async def cmd_start(self, message, args):
         """
         `$!_start <game name>` : Starts an interactive text adventure
@@ -358,7 +385,8 @@ def EnableStory(bot):
                     user,
                     "Congratulations on reaching level %d! Your weekly token payout"
                     " and maximum token balance have both been increased. To check"
-                    " your balance, type `$!balance`" % player['level']
+                    " your balance, type `$!balance`" % player['level'],
+                    wait=False
                 )
             players[user.id] = player
             players.save()
@@ -389,7 +417,8 @@ def EnableStory(bot):
     @bot.add_command(
         'bid',
         Arg('amount', type=int, help='Amount of tokens to bid'),
-        Arg('game', help="The game to play")
+        Arg('game', help="The game to play"),
+        lane='story'
     )
     async def cmd_bid(self, message, args):
         """
@@ -509,7 +538,7 @@ def EnableStory(bot):
                 )
             players.save()
 
-    @bot.add_command('reup', empty=True)
+    @bot.add_command('reup', empty=True, lane='story')
     async def cmd_reup(self, message, content):
         """
         `$!reup` : Extends your current game session by 1 day
@@ -540,13 +569,14 @@ def EnableStory(bot):
                     state['reup'] += 1
                     if 'notified' in state:
                         del state['notified']
+                    arm_game_timer(self, state)
                     await self.send_message(
                         self.fetch_channel('story'),
                         "The current game session has been extended"
                     )
                     state.save()
 
-    @bot.subscribe('endgame')
+    @bot.subscribe('endgame', lane=lambda *args: 'story')
     async def end_game(self, evt, user, dest):
         async with Database('game.json', {'user':'~<IDLE>'}) as state:
             async with Database('players.json') as players:
@@ -619,6 +649,7 @@ def EnableStory(bot):
                 del state['notified']
             state['user'] = '~<IDLE>'
             del self.player
+            self.cancel_timer('check_game')
             state.save()
             players.save()
             if 'bids' not in state or len(state['bids']) == 1:
@@ -629,7 +660,7 @@ def EnableStory(bot):
             else:
                 self.dispatch('startgame')
 
-    @bot.subscribe('startgame')
+    @bot.subscribe('startgame', lane=lambda *args: 'story')
     async def start_game(self, evt):
         async with Database('game.json', {'user':'~<IDLE>', 'bids':[]}) as state:
             async with Database('players.json') as players:
@@ -664,6 +695,7 @@ def EnableStory(bot):
                             state['time'] = time.time()
                             state['bids'] = [{'user':'', 'amount':0, 'game':''}]
                             state.save()
+                            arm_game_timer(self, state)
                             self.player = Player(bid['game'])
                             # in future:
                             # See if there's a way to change permissions of an existing channel
@@ -751,8 +783,8 @@ def EnableStory(bot):
             week[user.id]['active'] = True
             week.save()
 
-    @bot.subscribe('after:message')
-    async def record_activity(self, evt, message):
+    @bot.subscribe('after:message', inline=True)
+    def record_activity(self, evt, message):
         if message.author.id != self.user.id:
             self._pending_activity.add(message.author.id)
 
@@ -836,6 +868,7 @@ def EnableStory(bot):
             async with Database('weekly.json') as week:
                 print("Resetting the week")
                 xp = []
+                notices = []
                 for uid in week:
                     user = self.get_user(uid)
                     if uid not in players:
@@ -853,14 +886,15 @@ def EnableStory(bot):
                     if 'active' in week[uid] or uid in self._pending_activity:
                         xp.append([user, 5])
                         #only notify if they were active. Otherwise don't bother them
-                        await self.send_message(
-                            self.get_user(uid),
+                        notices.append((
+                            user,
                             "Your allowance was %d tokens this week. Your balance is now %d "
                             "tokens" % (
                                 payout,
                                 players[uid]['balance']
                             )
-                        )
+                        ))
+                self.fan_out(notices)
                 self._pending_activity = set()
                 players.save()
                 os.remove('weekly.json')
@@ -872,13 +906,14 @@ def EnableStory(bot):
                         payout
                     )
 
-    @bot.add_task(1800) # 30 minutes
-    async def check_game(self):
+    @bot.subscribe('check_game') # Timer set by arm_game_timer
+    async def check_game(self, event):
         async with Database('game.json', {'user':'~<IDLE>', 'bids':[]}) as state:
             now = time.time()
             if state['user'] != '~<IDLE>' and now - state['time'] >= 172800: # 2 days
                 user = self.get_user(state['user'])
                 self.dispatch('endgame', user, user)
+                return
             elif state['user'] != '~<IDLE>' and now - state['time'] >= 151200: # 6 hours left
                 if 'notified' not in state or state['notified'] == 'first':
                     await self.send_message(
@@ -905,4 +940,5 @@ def EnableStory(bot):
                     )
                     state['notified'] = 'first'
                     state.save()
+            arm_game_timer(self, state)
     return bot
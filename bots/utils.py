@@ -2,6 +2,11 @@ import json
 import sys
 import asyncio
 import warnings
+import re
+import time
+import random
+import zlib
+from functools import lru_cache
 
 db_lock = asyncio.Lock()
 locks = {}
@@ -136,6 +141,34 @@ class Interpolator(dict):
             '$PREFIX': bot.command_prefix,
             '$!': bot.command_prefix
         })
+        self.pattern = interpolation_pattern(frozenset(self))
+
+@lru_cache(maxsize=64)
+def interpolation_pattern(keys):
+    # keys: a frozenset of placeholders
+    # Returns (the placeholders' first characters, a pattern matching any placeholder)
+    # Longer placeholders are matched first
+    return (
+        frozenset(key[:1] for key in keys),
+        re.compile('|'.join(
+            re.escape(key)
+            for key in sorted(keys, key=len, reverse=True)
+        ))
+    )
+
+def interpolate(content, interp):
+    # Replaces every placeholder in one pass over the content
+    if not len(interp):
+        return content
+    if isinstance(interp, Interpolator):
+        leads, pattern = interp.pattern
+    else:
+        leads, pattern = interpolation_pattern(frozenset(interp))
+    for lead in leads:
+        # Most messages have no placeholders. Checking for the first characters is much cheaper than the regex
+        if lead in content:
+            return pattern.sub(lambda match: interp[match.group(0)], content)
+    return content
 
 def sanitize(string, illegal, replacement=''):
     for char in illegal:
@@ -164,3 +197,303 @@ def validate_permissions(obj, is_default=False):
     if not ('allow' in obj or 'deny' in obj  or 'underscore' in obj):
         sys.exit("Permissions object must set some permission (allow, deny, or underscore)")
     return
+
+class PermissionRule(object):
+    # Compiled form of a single permissions.yml rule
+    # allow and deny are frozensets of commands (without the prefix)
+    # underscore is None if the rule does not set it
+    __slots__ = ('allow', 'deny', 'allow_all', 'deny_all', 'underscore', 'grant', 'source')
+
+    def __init__(self, obj, grant):
+        allow = obj['allow'] if 'allow' in obj and obj['allow'] is not None else []
+        deny = obj['deny'] if 'deny' in obj and obj['deny'] is not None else []
+        self.allow_all = '$all' in allow
+        self.deny_all = '$all' in deny
+        self.allow = frozenset(allow)
+        self.deny = frozenset(deny)
+        self.underscore = obj['underscore'] if 'underscore' in obj else None
+        self.grant = grant
+        self.source = obj
+
+    def check(self, cmd):
+        # Returns True or False if this rule decides the command, otherwise None
+        if self.allow_all or cmd in self.allow:
+            return True
+        if self.deny_all or cmd in self.deny:
+            return False
+        if self.underscore is not None and cmd[:1] == '_':
+            return self.underscore
+        return None
+
+    def resolve(self, pending, underscored):
+        # Set-based version of check() over many commands at once
+        # pending: set of undecided commands, underscored: the subset starting with _
+        # Returns (allowed, denied). Both are removed from pending
+        allowed = set(pending) if self.allow_all else pending & self.allow
+        pending -= allowed
+        denied = set(pending) if self.deny_all else pending & self.deny
+        pending -= denied
+        if self.underscore is not None:
+            decided = pending & underscored
+            pending -= decided
+            if self.underscore:
+                allowed |= decided
+            else:
+                denied |= decided
+        return allowed, denied
+
+class PermissionCache(object):
+    # Caches permissions chains and decisions keyed on a user's role-set signature
+    # signature = (user id if the user has their own rules else None, frozenset(role ids with rules))
+    def __init__(self):
+        self.signatures = {} # (user id, server id) -> signature
+        self.chains = {} # signature -> chain
+        self.decisions = {} # (signature, cmd) -> (allowed, grant)
+        self.hits = 0
+        self.misses = 0
+
+    def forget(self, uid):
+        # Drop cached signatures for a user (ie: their roles changed)
+        for key in [key for key in self.signatures if key[0] == uid]:
+            del self.signatures[key]
+
+    def clear(self):
+        # Drop everything except the counters
+        self.signatures = {}
+        self.chains = {}
+        self.decisions = {}
+
+class RateLimit(object):
+    # Compiled form of a command's entry in the rate_limits section of config.yml
+    # uses: number of uses allowed per period (in seconds)
+    # roles and users map role names/ids and user ids to a different number of uses
+    # 0 uses means no limit
+    __slots__ = ('uses', 'per', 'roles', 'users')
+
+    def __init__(self, command, obj):
+        if not ('uses' in obj and 'per' in obj):
+            sys.exit("Rate limit for %s must set uses and per" % command)
+        self.uses = obj['uses']
+        self.per = obj['per']
+        self.roles = {str(k):v for k,v in obj['roles'].items()} if 'roles' in obj else {}
+        self.users = {str(k):v for k,v in obj['users'].items()} if 'users' in obj else {}
+
+    def uses_for(self, user, roles):
+        # User overrides win. Otherwise the most generous role applies
+        if user.id in self.users:
+            return self.users[user.id]
+        uses = None
+        for role in roles:
+            for key in (role.id, role.name):
+                if key in self.roles and (uses is None or self.roles[key] == 0 or (uses != 0 and self.roles[key] > uses)):
+                    uses = self.roles[key]
+        return self.uses if uses is None else uses
+
+class RateLimiter(object):
+    # Token buckets for (command, user id) pairs
+    # A bucket holds up to uses tokens and refills at uses/per tokens per second
+    # Buckets which have completely refilled are the same as new ones, so
+    # they are evicted by sweep()
+    def __init__(self):
+        self.buckets = {} # (command, user id) -> [tokens, last update, time when full]
+        self.notified = {} # (command, user id) -> time until which the user has been told they're throttled
+        self.swept = time.time()
+        self.throttled = 0
+
+    def take(self, key, uses, per, now=None):
+        # Takes a token from the bucket. Returns 0 if the token was available,
+        # otherwise the number of seconds until it will be
+        if now is None:
+            now = time.time()
+        if now - self.swept >= 60:
+            self.sweep(now)
+        rate = uses / per
+        if key in self.buckets:
+            tokens, last, full = self.buckets[key]
+            tokens = min(uses, tokens + (now - last) * rate)
+        else:
+            tokens = uses
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+            self.throttled += 1
+        self.buckets[key] = [tokens, now, now + (uses - tokens) / rate]
+        return wait
+
+    def should_notify(self, key, wait, now=None):
+        # Only tell the user once per throttled period
+        if now is None:
+            now = time.time()
+        if key in self.notified and self.notified[key] > now:
+            return False
+        self.notified[key] = now + wait
+        return True
+
+    def sweep(self, now):
+        self.swept = now
+        self.buckets = {
+            key:bucket for key, bucket in self.buckets.items()
+            if bucket[2] > now
+        }
+        self.notified = {
+            key:until for key, until in self.notified.items()
+            if until > now
+        }
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+class TextIndex(object):
+    # Inverted index from words to document ids
+    # A document's text is indexed under one or more fields (ie: content,
+    # label). Setting a field replaces its words, while adding to a field
+    # keeps the words already there
+    def __init__(self):
+        self.postings = {} # word -> {document ids}
+        self.fields = {} # document id -> {field: frozenset(words)}
+
+    def set(self, doc, field, text):
+        words = frozenset(tokenize(text))
+        if doc not in self.fields:
+            self.fields[doc] = {}
+        fields = self.fields[doc]
+        old = fields[field] if field in fields else frozenset()
+        fields[field] = words
+        for word in old - words:
+            # Only drop the posting if no other field has the word
+            if not any(word in other for other in fields.values()):
+                self.postings[word].discard(doc)
+                if not len(self.postings[word]):
+                    del self.postings[word]
+        for word in words - old:
+            if word not in self.postings:
+                self.postings[word] = set()
+            self.postings[word].add(doc)
+
+    def add(self, doc, field, text):
+        if doc in self.fields and field in self.fields[doc]:
+            text += ' ' + ' '.join(self.fields[doc][field])
+        self.set(doc, field, text)
+
+    def search(self, text):
+        # Returns the set of documents containing every word in the text
+        words = set(tokenize(text))
+        if not len(words):
+            return set()
+        postings = []
+        for word in words:
+            if word not in self.postings:
+                return set()
+            postings.append(self.postings[word])
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+MERSENNE = (1 << 61) - 1
+
+class MinHashIndex(object):
+    # Finds near-duplicate texts without comparing against every document
+    # Each text gets a MinHash signature over its word pairs. Signatures are
+    # split into bands, and documents sharing any band are candidates. Only
+    # the candidates are ranked, by the fraction of matching signature values
+    # (an estimate of the Jaccard similarity of the word pairs)
+    def __init__(self, permutations=32, bands=8, seed=0):
+        rng = random.Random(seed)
+        self.permutations = [
+            (rng.randrange(1, MERSENNE), rng.randrange(0, MERSENNE))
+            for _ in range(permutations)
+        ]
+        self.bands = bands
+        self.rows = permutations // bands
+        self.signatures = {} # document id -> signature
+        self.buckets = {} # (band, band values) -> {document ids}
+
+    def shingles(self, text):
+        # The text's word pairs (or its only word). Empty if it has no words
+        words = tokenize(text)
+        return {
+            ' '.join(words[i:i+2])
+            for i in range(max(len(words) - 1, 1))
+        } if len(words) else set()
+
+    def signature(self, text):
+        # Returns None if the text has no words, since there's nothing to compare
+        shingles = self.shingles(text)
+        if not len(shingles):
+            return None
+        hashes = [zlib.crc32(shingle.encode()) for shingle in shingles]
+        return tuple(
+            min((a * h + b) % MERSENNE for h in hashes)
+            for a, b in self.permutations
+        )
+
+    def _bands(self, signature):
+        for band in range(self.bands):
+            yield (band, signature[band*self.rows:(band+1)*self.rows])
+
+    def add(self, doc, text):
+        signature = self.signature(text)
+        if signature is None:
+            return
+        self.signatures[doc] = signature
+        for key in self._bands(signature):
+            if key not in self.buckets:
+                self.buckets[key] = set()
+            self.buckets[key].add(doc)
+
+    def query(self, text, threshold=0):
+        # Returns [(similarity, document id)] for candidates at or above the
+        # threshold, most similar first
+        signature = self.signature(text)
+        if signature is None:
+            return []
+        candidates = set()
+        for key in self._bands(signature):
+            if key in self.buckets:
+                candidates |= self.buckets[key]
+        matches = []
+        for doc in candidates:
+            similarity = sum(
+                1 for x, y in zip(signature, self.signatures[doc]) if x == y
+            ) / len(signature)
+            if similarity >= threshold:
+                matches.append((similarity, doc))
+        return sorted(matches, key=lambda match: (-match[0], match[1]))
+
+def chunk_message(content, quote='', target=1024):
+    # Splits a message into chunks that Discord will accept, in a single pass.
+    # Chunks are split by lines where possible. A chunk is emitted as soon as it
+    # grows past the target size. If adding a line would make the chunk too
+    # large, that chunk is split by sentences instead (then by words, and
+    # finally by characters). Quote is the fence which will be placed around
+    # each chunk (ie: ```), and is accounted for in the size limit
+    limit = 2000 - 2*len(quote)
+    yield from _chunk_message(
+        content,
+        [('\n', min(1536, limit)), ('. ', limit), (' ', limit)],
+        target,
+        limit
+    )
+
+def _chunk_message(content, levels, target, limit):
+    if not len(levels):
+        for i in range(0, len(content), limit):
+            yield content[i:i+limit]
+        return
+    delim, cap = levels[0]
+    chunk = []
+    size = -len(delim)
+    for piece in content.split(delim):
+        chunk.append(piece)
+        size += len(delim) + len(piece)
+        if size > cap:
+            yield from _chunk_message(delim.join(chunk), levels[1:], target, limit)
+            chunk = []
+            size = -len(delim)
+        elif size > target:
+            yield delim.join(chunk)
+            chunk = []
+            size = -len(delim)
+    if len(chunk):
+        yield delim.join(chunk)
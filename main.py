@@ -87,29 +87,26 @@ def ConstructBeymax(): #enable Beymax-Specific commands
         )
         if not member.bot:
             await asyncio.sleep(10)
-            message = await self.send_message(
+            response = await self.prompt(
+                member,
                 member,
                 "We're glad to have you on our server! Would you like a brief "
                 "introduction on what I can do? (Yes/No)"
             )
-            response = await self.wait_for_message(
-                channel=message.channel,
-                # check=lambda x:x.content.lower() in {'yes', 'no'}
-            )
             if response is None or response.content.lower() == 'no':
                 await self.send_message(
-                    message.channel,
+                    member,
                     "Alright. Have fun, and enjoy your stay!"
                 )
                 return
             elif response.content.lower() != 'yes':
                 await self.send_message(
-                    message.channel,
+                    member,
                     "I didn't understand your response, but I'll go ahead and"
                     " give you the rundown anyways"
                 )
             await self.send_message(
-                message.channel,
+                member,
                 "You can use the `$!birthday` command so I'll post a message on your birthday. "
                 "If you're an Overwatch player, you can use `$!ow` and I'll keep track of your competitive rank. "
                 "You can use the `$!party` command if you want to make a voice channel for you your friends to hang out for a while. "